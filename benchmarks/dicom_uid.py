@@ -0,0 +1,90 @@
+"""Сравнение полного чтения DICOM файла и чтения только SOPInstanceUID.
+
+Запуск из корня проекта:
+    python -m benchmarks.dicom_uid --size-mb 200 --repeat 5
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, SecondaryCaptureImageStorage
+
+from src.dicom.constants import SOP_INSTANCE_UID_TAG
+from src.dicom.repository import DicomRepository
+
+
+def make_dicom_file(path: str, size_mb: int) -> str:
+    """Создает DICOM файл с пиксельными данными примерно указанного размера"""
+    sop_instance_uid = generate_uid()
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.PatientName = 'Benchmark^Patient'
+    ds.PatientID = '0'
+    ds.Modality = 'OT'
+
+    side = 1024
+    frames = max(1, size_mb * 1024 * 1024 // (side * side * 2))
+    ds.Rows = side
+    ds.Columns = side
+    ds.NumberOfFrames = frames
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = bytes(frames * side * side * 2)
+    ds.save_as(path, enforce_file_format=True)
+    return sop_instance_uid
+
+
+def read_bytes() -> int:
+    """Количество байт, прочитанных процессом (rchar из /proc/self/io)"""
+    with open('/proc/self/io') as io:
+        for line in io:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(path: str, tags: list[str] | None, repeat: int) -> dict:
+    timings = []
+    bytes_read = []
+    for _ in range(repeat):
+        rchar = read_bytes()
+        start = time.perf_counter()
+        DicomRepository(path, tags=tags).get_tag(SOP_INSTANCE_UID_TAG)
+        timings.append(time.perf_counter() - start)
+        bytes_read.append(read_bytes() - rchar)
+    return {
+        'median_ms': statistics.median(timings) * 1000,
+        'bytes_read': statistics.median(bytes_read),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'image.dcm')
+        make_dicom_file(path, args.size_mb)
+        print(f'Размер файла: {os.path.getsize(path) / 1024 / 1024:.1f} МБ')
+        for name, tags in (('полное чтение', None), ('только SOPInstanceUID', [SOP_INSTANCE_UID_TAG])):
+            result = measure(path, tags, args.repeat)
+            print(f'{name}: {result["median_ms"]:.2f} мс, прочитано {result["bytes_read"]:.0f} байт')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+"""Сквозной бенчмарк FileSyncApp.run() на синтетических томах PACS.
+
+Генерирует том источника с директориями по датам, маленькими DICOM файлами (с id в имени и без),
+нечитаемыми файлами и соответствующими строками shares/images в Postgres. Postgres берется по --dsn
+либо запускается временный локальный сервер (initdb/pg_ctl из --pg-bin или PATH, не от root).
+Результат (файлов/с, МБ/с, запросов в БД, перцентили по этапам, включая вызовы логгера в потоках переноса,
+прирост страничного кеша) сохраняется в benchmarks/results
+в JSON для сравнения между коммитами. Запуск из корня проекта:
+    python -m benchmarks.pacs --dirs 3 --files-per-dir 2000 --workers 4
+    python -m benchmarks.pacs --log-level debug --log-format json
+    python -m benchmarks.pacs --dsn "host=... dbname=..." --compare benchmarks/results/<файл>.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import string
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extras
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, SecondaryCaptureImageStorage
+
+import src.app
+from src.app import FileSyncApp
+from src.copier import CopyStrategy, VerifyMode
+from src.database import DatabaseConnector
+from src.iohygiene import evict_file_from_cache, set_idle_io_priority
+from src.logger import LogFormat, configure_logging, stop_logging
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+VOLUME_FROM = 1
+VOLUME_TO = 2
+
+SCHEMA = """
+create table shares (
+    share_uid integer primary key,
+    share_path text not null
+);
+create table images (
+    image_uid integer primary key,
+    share_uid integer not null,
+    image_path text not null,
+    images_uid_in_file text
+);
+create index images_uid_in_file_idx on images (images_uid_in_file);
+"""
+
+
+def random_name(length: int = 12) -> str:
+    """Имя файла без цифр - id из него не извлекается"""
+    return ''.join(random.choices(string.ascii_lowercase, k=length))
+
+
+def write_dicom(path: str, sop_instance_uid: str, size_kb: int):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.PatientName = 'Benchmark^Patient'
+    ds.PatientID = '0'
+    ds.Modality = 'OT'
+    ds.PixelData = os.urandom(size_kb * 1024)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def generate_volume(
+    volume_path: str,
+    dirs: int,
+    files_per_dir: int,
+    size_kb: tuple[int, int],
+    no_id_ratio: float,
+    unreadable_ratio: float,
+    older_days: int,
+) -> tuple[list[tuple], int]:
+    """Создает директории по датам с файлами. Возвращает строки images и общий объем файлов"""
+    images = []
+    total_bytes = 0
+    image_id = 1000
+    first_date = datetime.now() - timedelta(days=older_days + dirs)
+    for day in range(dirs):
+        dir_name = (first_date + timedelta(days=day)).strftime('%Y-%m-%d')
+        dir_path = os.path.join(volume_path, dir_name)
+        os.makedirs(dir_path)
+        for _ in range(files_per_dir):
+            kind = random.random()
+            if kind < unreadable_ratio:
+                path = os.path.join(dir_path, random_name())
+                with open(path, 'wb') as file:
+                    file.write(os.urandom(random.randint(*size_kb) * 1024))
+            else:
+                image_id += 1
+                sop_instance_uid = generate_uid()
+                name = random_name() if kind < unreadable_ratio + no_id_ratio else f'{image_id}.dcm'
+                path = os.path.join(dir_path, name)
+                write_dicom(path, sop_instance_uid, random.randint(*size_kb))
+                images.append((image_id, VOLUME_FROM, f'{dir_name}/{name}', sop_instance_uid))
+            total_bytes += os.path.getsize(path)
+    return images, total_bytes
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def local_postgres(pg_bin: str | None):
+    """Временный сервер Postgres в отдельной директории. Возвращает DSN"""
+    def binary(name: str) -> str:
+        path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise SystemExit(f'Не найден {name}: укажите --pg-bin или --dsn.')
+        return path
+
+    data_dir = tempfile.mkdtemp(prefix='bench-pg-')
+    port = free_port()
+    subprocess.run(
+        [binary('initdb'), '-D', data_dir, '-U', 'postgres', '-A', 'trust'],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    subprocess.run(
+        [binary('pg_ctl'), '-D', data_dir, '-o', f'-k {data_dir} -p {port} -h 127.0.0.1',
+         '-l', os.path.join(data_dir, 'server.log'), '-w', 'start'],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield f'host=127.0.0.1 port={port} dbname=postgres user=postgres'
+    finally:
+        subprocess.run([binary('pg_ctl'), '-D', data_dir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def prepare_database(dsn: str, volume_from_path: str, volume_to_path: str, images: list[tuple]):
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute('drop table if exists images; drop table if exists shares;')
+        cur.execute(SCHEMA)
+        cur.execute(
+            'insert into shares (share_uid, share_path) values (%s, %s), (%s, %s)',
+            (VOLUME_FROM, volume_from_path, VOLUME_TO, volume_to_path),
+        )
+        psycopg2.extras.execute_values(
+            cur,
+            'insert into images (image_uid, share_uid, image_path, images_uid_in_file) values %s',
+            images,
+            page_size=1000,
+        )
+    conn.close()
+
+
+class CountingConnector(DatabaseConnector):
+    """Считает обращения к БД (каждый execute и каждую страницу execute_values)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self._counter_lock = threading.Lock()
+
+    def _count(self, number: int = 1):
+        with self._counter_lock:
+            self.round_trips += number
+
+    def execute(self, query: str, params=None):
+        self._count()
+        return super().execute(query, params)
+
+    def execute_values(self, query: str, rows: list[tuple], page_size: int = 100):
+        self._count(-(-len(rows) // page_size))
+        return super().execute_values(query, rows, page_size=page_size)
+
+
+class StageTimer:
+    """Замеряет длительность этапов переноса, подменяя функции в модуле src.app"""
+
+    def __init__(self):
+        self.durations: dict[str, list[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._originals: list[tuple[object, str, object]] = []
+        # Замеряемые этапы потока: вложенный вызов того же этапа (Logger.exception -> error) не учитывается дважды
+        self._active = threading.local()
+
+    def _record(self, stage: str, duration: float):
+        with self._lock:
+            self.durations[stage].append(duration)
+
+    def wrap(self, owner: object, name: str, stage: str):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            active = self._active.__dict__.setdefault('stages', set())
+            if stage in active:
+                return original(*args, **kwargs)
+            active.add(stage)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._record(stage, time.perf_counter() - start)
+                active.discard(stage)
+
+        self._originals.append((owner, name, original))
+        setattr(owner, name, timed)
+
+    def install(self, app: FileSyncApp):
+        self.wrap(src.app, 'extract_image_id_from_name', 'extract_id')
+        self.wrap(src.app, 'DicomService', 'dicom_parse')
+        self.wrap(src.app, 'copy_file', 'copy')
+        self.wrap(src.app, 'link_file', 'copy')
+        self.wrap(src.app, 'remove_file', 'unlink')
+        self.wrap(src.app, 'remove_dir', 'dir_remove')
+        repository = app.makstor_repository
+        for name in ('get_images_by_ids', 'get_images_by_uids', 'get_image_by_id', 'get_image_by_uid'):
+            self.wrap(repository, name, 'db_lookup')
+        self.wrap(repository, 'update_images', 'db_update')
+        # Стоимость логирования в вызывающем потоке, в том числе вызовов ниже уровня лога
+        for name in ('debug', 'info', 'warning', 'error', 'exception', 'log'):
+            self.wrap(logging.Logger, name, 'log')
+
+    def uninstall(self):
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals.clear()
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        result = {}
+        for stage, durations in sorted(self.durations.items()):
+            durations = sorted(durations)
+            result[stage] = {
+                'count': len(durations),
+                'total_s': sum(durations),
+                'p50_ms': percentile(durations, 50) * 1000,
+                'p90_ms': percentile(durations, 90) * 1000,
+                'p99_ms': percentile(durations, 99) * 1000,
+            }
+        return result
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def page_cache_mb() -> dict[str, float]:
+    """Объем страничного кеша и грязных страниц из /proc/meminfo, МБ"""
+    values = {}
+    with open('/proc/meminfo') as file:
+        for line in file:
+            key, value = line.split(':', 1)
+            if key in ('Cached', 'Dirty'):
+                values[key.lower()] = int(value.split()[0]) / 1024
+    return values
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(args: argparse.Namespace, dsn: str, work_dir: str, volume_to_dir: str) -> dict:
+    volume_from_path = os.path.join(work_dir, 'volume_from')
+    volume_to_path = os.path.join(volume_to_dir, 'volume_to')
+    dir_not_found = os.path.join(volume_to_dir, 'not_found')
+    for path in (volume_from_path, volume_to_path, dir_not_found):
+        os.makedirs(path)
+
+    random.seed(args.seed)
+    images, total_bytes = generate_volume(
+        volume_from_path,
+        dirs=args.dirs,
+        files_per_dir=args.files_per_dir,
+        size_kb=(args.min_size_kb, args.max_size_kb),
+        no_id_ratio=args.no_id_ratio,
+        unreadable_ratio=args.unreadable_ratio,
+        older_days=args.older_days,
+    )
+    prepare_database(dsn, volume_from_path, volume_to_path, images)
+    total_files = args.dirs * args.files_per_dir
+
+    params = psycopg2.extensions.parse_dsn(dsn)
+    db_connector = CountingConnector(
+        dbname=params.get('dbname'),
+        user=params.get('user'),
+        password=params.get('password'),
+        host=params.get('host'),
+        port=int(params.get('port', 5432)),
+        pool_size=args.workers + 1,
+    )
+    app = FileSyncApp(
+        db_connector=db_connector,
+        volume_from=VOLUME_FROM,
+        volume_to=VOLUME_TO,
+        move_older_days=args.older_days,
+        dir_not_found=dir_not_found,
+        uid=None,
+        gid=None,
+        is_volume_to_network=False,
+        is_dir_not_found_network=False,
+        workers=args.workers,
+        copy_strategies=tuple(CopyStrategy(name) for name in args.copy_strategies.split(',')),
+        verify_copy=VerifyMode(args.verify_copy),
+        io_fadvise=args.io_fadvise,
+    )
+    # Сгенерированный том целиком в кеше - вытесняю его, чтобы замер начинался с холодного кеша
+    for dir_path, _, file_names in os.walk(volume_from_path):
+        for file_name in file_names:
+            evict_file_from_cache(os.path.join(dir_path, file_name))
+    cache_before = page_cache_mb()
+    timer = StageTimer()
+    timer.install(app)
+    start = time.perf_counter()
+    try:
+        app.run()
+    finally:
+        elapsed = time.perf_counter() - start
+        timer.uninstall()
+        db_connector.close()
+    cache_after = page_cache_mb()
+
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'params': vars(args),
+        'files': total_files,
+        'bytes': total_bytes,
+        'elapsed_s': elapsed,
+        'files_per_s': total_files / elapsed,
+        'mb_per_s': total_bytes / 1024 / 1024 / elapsed,
+        'db_round_trips': db_connector.round_trips,
+        'stages': timer.summary(),
+        'page_cache_mb': {
+            'before': cache_before,
+            'after': cache_after,
+            'growth': cache_after['cached'] - cache_before['cached'],
+        },
+    }
+
+
+def print_result(result: dict, previous: dict | None = None):
+    def delta(key: str) -> str:
+        if not previous or not previous.get(key):
+            return ''
+        return f' ({(result[key] / previous[key] - 1) * 100:+.1f}% к {previous["commit"]})'
+
+    print(f'Коммит {result["commit"]}: {result["files"]} файлов, {result["bytes"] / 1024 / 1024:.1f} МБ '
+          f'за {result["elapsed_s"]:.2f} с')
+    print(f'  файлов/с: {result["files_per_s"]:.1f}{delta("files_per_s")}')
+    print(f'  МБ/с: {result["mb_per_s"]:.1f}{delta("mb_per_s")}')
+    print(f'  запросов в БД: {result["db_round_trips"]}{delta("db_round_trips")}')
+    if 'log_bytes' in result:
+        print(f'  записано в лог: {result["log_bytes"] / 1024:.1f} КБ')
+    if 'page_cache_mb' in result:
+        print(f'  прирост страничного кеша: {result["page_cache_mb"]["growth"]:.1f} МБ, '
+              f'грязных страниц после: {result["page_cache_mb"]["after"]["dirty"]:.1f} МБ')
+    for stage, stats in result['stages'].items():
+        print(f'  {stage}: n={stats["count"]} всего={stats["total_s"]:.3f} с '
+              f'p50={stats["p50_ms"]:.2f} p90={stats["p90_ms"]:.2f} p99={stats["p99_ms"]:.2f} мс')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirs', type=int, default=2)
+    parser.add_argument('--files-per-dir', type=int, default=500)
+    parser.add_argument('--min-size-kb', type=int, default=64)
+    parser.add_argument('--max-size-kb', type=int, default=512)
+    parser.add_argument('--no-id-ratio', type=float, default=0.05, help='доля файлов без id в имени')
+    parser.add_argument('--unreadable-ratio', type=float, default=0.02, help='доля нечитаемых файлов')
+    parser.add_argument('--older-days', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--copy-strategies', default=','.join(CopyStrategy))
+    parser.add_argument('--verify-copy', default=VerifyMode.off, choices=list(VerifyMode))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--io-fadvise', action=argparse.BooleanOptionalAction, default=True,
+                        help='предварительное чтение и вытеснение файлов из кеша при копировании')
+    parser.add_argument('--io-idle-priority', action='store_true', help='класс ввода-вывода idle')
+    parser.add_argument('--work-dir', help='директория для тома источника (по умолчанию временная)')
+    parser.add_argument('--volume-to-dir', help='директория для целевого тома, например на другой ФС или NFS '
+                                                '(по умолчанию рядом с томом источника)')
+    parser.add_argument('--dsn', help='DSN существующей БД (таблицы shares/images будут пересозданы)')
+    parser.add_argument('--pg-bin', help='директория с initdb и pg_ctl для временного сервера')
+    parser.add_argument('--compare', help='JSON результата предыдущего запуска для сравнения')
+    parser.add_argument('--log-level', default='info', help='уровень лога, пишется в log.txt рабочей директории')
+    parser.add_argument('--log-format', default=LogFormat.text, choices=list(LogFormat))
+    args = parser.parse_args()
+
+    if args.io_idle_priority:
+        set_idle_io_priority()
+
+    with (
+        tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir,
+        tempfile.TemporaryDirectory(dir=args.volume_to_dir or work_dir) as volume_to_dir,
+    ):
+        # Логирование как в main.py, чтобы замер включал его накладные расходы
+        log_path = os.path.join(work_dir, 'log.txt')
+        configure_logging(args.log_level, log_path, args.log_format)
+        if args.dsn:
+            result = run_benchmark(args, args.dsn, work_dir, volume_to_dir)
+        else:
+            with local_postgres(args.pg_bin) as dsn:
+                result = run_benchmark(args, dsn, work_dir, volume_to_dir)
+        stop_logging()
+        result['log_bytes'] = os.path.getsize(log_path)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_path = os.path.join(RESULTS_DIR, f'{datetime.now():%Y%m%d-%H%M%S}-{result["commit"]}.json')
+    with open(result_path, 'w') as file:
+        json.dump(result, file, indent=2, ensure_ascii=False)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print_result(result, previous)
+    print(f'Результат сохранен в {result_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,25 @@
+import argparse
 import logging
 import os
+import signal
+import sys
 
 from datetime import datetime
-from time import sleep
 
 from src.app import FileSyncApp
+from src.breaker import CircuitBreaker
+from src.checksums import ChecksumStore
 from src.config import Config
 from src.database import DatabaseConnector
+from src.exceptions import DBConnectError, DBExecuteQueryError
+from src.journal import Journal
+from src.makstor.repository import MakstorRepository
+from src.policies import PolicyRunner
+from src.reconcile import Reconciler
+from src.scheduler import Scheduler
+from src.throttle import CopyThrottle, make_throttle
+from src.uid_cache import UidCache
+from src.iohygiene import set_idle_io_priority
 from src.logger import configure_logging
 from src.utils import get_uid_gid
 
@@ -19,6 +32,10 @@ config = Config('config.ini').read()
 configure_logging(
     level=config.log_level,
     filename=os.path.join(main_path, 'log.txt'),
+    log_format=config.log_format,
+    max_bytes=config.log_max_mb * 1024 * 1024,
+    backup_count=config.log_backup_count,
+    rotate_when=config.log_rotate_when,
 )
 
 # Конфигурирую подключение к БД
@@ -28,27 +45,150 @@ db_connector = DatabaseConnector(
     password=config.db_password,
     host=config.db_host,
     port=config.db_port,
+    pool_size=config.db_pool_size,
+)
+# Размыкатель цепи БД, общий для всех политик
+db_breaker = CircuitBreaker('БД', config.breaker_failure_threshold, config.breaker_reset_s)
+
+# Хеши скопированных файлов
+checksum_store = ChecksumStore(os.path.join(main_path, 'checksums.db'))
+# Журнал незавершенных переносов
+journal = Journal(os.path.join(main_path, 'journal.db'))
+# Кеш uid из DICOM файлов
+uid_cache = UidCache(
+    os.path.join(main_path, 'uid_cache.db'),
+    max_entries=config.uid_cache_size,
+    lookup_ttl=config.uid_cache_lookup_ttl_hours * 3600,
 )
 
 logger = logging.getLogger(__name__)
 
+# Планировщик окон запуска. Внеочередной запуск - флаг --now или сигнал SIGUSR1
+scheduler = Scheduler(config.schedule)
+
+
+def create_apps(uid: int | None, gid: int | None) -> list[FileSyncApp]:
+    """Переносы по политикам из конфига. Ограничения копирования и размыкатели цепи создаются
+    по одному на целевой том и директорию для ненайденных и общие для политик, которые в них пишут"""
+    throttle_args = (
+        config.throttle_mb_per_s * 1024 * 1024,
+        config.throttle_files_per_s,
+        config.throttle_adaptive,
+        config.throttle_latency_ms / 1000,
+    )
+    throttles: dict[tuple, CopyThrottle | None] = {}
+    breakers: dict[tuple, CircuitBreaker] = {}
+
+    def volume_throttle(key: tuple, name: str, is_network: bool) -> CopyThrottle | None:
+        if (key, is_network) not in throttles:
+            throttles[key, is_network] = make_throttle(name, is_network, *throttle_args)
+        return throttles[key, is_network]
+
+    def volume_breaker(key: tuple, name: str) -> CircuitBreaker:
+        if key not in breakers:
+            breakers[key] = CircuitBreaker(name, config.breaker_failure_threshold, config.breaker_reset_s)
+        return breakers[key]
+
+    return [
+        FileSyncApp(
+            db_connector=db_connector,
+            volume_from=policy.volume_from,
+            volume_to=policy.volume_to,
+            move_older_days=policy.move_older_days,
+            uid=uid,
+            gid=gid,
+            dir_not_found=policy.dir_not_found,
+            is_volume_to_network=policy.is_volume_to_network,
+            is_dir_not_found_network=policy.is_dir_not_found_network,
+            workers=config.workers,
+            copy_strategies=config.copy_strategies,
+            verify_copy=config.verify_copy,
+            checksum_store=checksum_store,
+            journal=journal,
+            uid_cache=uid_cache,
+            metrics_dir=config.metrics_dir or os.path.join(main_path, 'metrics'),
+            throttle_bytes_per_s=config.throttle_mb_per_s * 1024 * 1024,
+            throttle_files_per_s=config.throttle_files_per_s,
+            throttle_adaptive=config.throttle_adaptive,
+            throttle_latency=config.throttle_latency_ms / 1000,
+            name=policy.name,
+            target_high_watermark=policy.target_high_watermark,
+            source_low_watermark=policy.source_low_watermark,
+            io_fadvise=config.io_fadvise,
+            file_records_level=logging.getLevelName(config.log_file_records_level),
+            chunked_copy_threshold=config.chunked_copy_threshold_mb * 1024 * 1024,
+            chunk_size=max(config.chunk_size_mb, 1) * 1024 * 1024,
+            chunk_retries=config.chunk_retries,
+            db_breaker=db_breaker,
+            volume_to_throttle=volume_throttle(
+                ('volume', policy.volume_to), f'целевой том {policy.volume_to}', policy.is_volume_to_network),
+            dir_not_found_throttle=volume_throttle(
+                ('path', policy.dir_not_found), policy.dir_not_found, policy.is_dir_not_found_network),
+            volume_to_breaker=volume_breaker(('volume', policy.volume_to), f'Целевой том {policy.volume_to}'),
+            dir_not_found_breaker=volume_breaker(('path', policy.dir_not_found), policy.dir_not_found),
+            breaker_failure_threshold=config.breaker_failure_threshold,
+            breaker_reset_timeout=config.breaker_reset_s,
+            retry_attempts=config.retry_attempts,
+            retry_delay=config.retry_delay_s,
+        )
+        for policy in config.policies
+    ]
+
+
 if __name__ == '__main__':
-    logger.info('Программа запущена.')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--now', action='store_true', help='запустить перенос сразу, не дожидаясь расписания')
+    parser.add_argument('--plan', action='store_true',
+                        help='вывести план переноса и оценку длительности без копирования и обновлений в БД')
+    parser.add_argument('--parse-dicom', action='store_true',
+                        help='в плане искать в БД файлы без id в имени по uid из DICOM')
+    parser.add_argument('--reconcile', type=int, nargs='+', metavar='SHARE_UID',
+                        help='сверить строки images томов с файлами на них, отчеты пишутся в reconcile/')
+    parser.add_argument('--reconcile-fixes', action='store_true',
+                        help='при сверке записать пакеты SQL удаления строк без файлов (не выполняются)')
+    args = parser.parse_args()
+
+    # Приоритеты наследуются потоками переноса, поэтому устанавливаются до их запуска
+    if config.io_idle_priority:
+        set_idle_io_priority(config.io_nice)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: scheduler.trigger())
+    if args.now:
+        scheduler.trigger()
+
+    try:
+        if args.plan:
+            next_run = scheduler.next_run(datetime.now())
+            for app in create_apps(uid=None, gid=None):
+                print(app.plan(parse_dicom=args.parse_dicom, deadline=next_run.deadline if next_run else None).format())
+            sys.exit()
+
+        if args.reconcile:
+            reconciler = Reconciler(MakstorRepository(db_connector), os.path.join(main_path, 'reconcile'))
+            for share_uid in args.reconcile:
+                try:
+                    result = reconciler.run(share_uid, write_fixes=args.reconcile_fixes)
+                except (DBConnectError, DBExecuteQueryError) as err:
+                    logger.error(f'Не удалось выполнить запрос в БД. Ошибка: {err}')
+                    result = None
+                print(result or f'Не удалось сверить том {share_uid}, подробности в log.txt.')
+            sys.exit()
+
+        logger.info('Программа запущена.')
 
-    while True:
-        if config.start_time == datetime.now().time().replace(second=0, microsecond=0):
+        while True:
+            scheduled_run = scheduler.wait()
+            if scheduled_run.deadline:
+                logger.info(f'Окно запуска до {scheduled_run.deadline:%Y-%m-%d %H:%M}.')
             uid, gid = get_uid_gid(config.owner_name, config.group_name)
             logger.info(f'Запущен перенос файлов '
                         f'UID:{config.owner_name}:{uid}, GID:{config.group_name}:{gid}.')
-            FileSyncApp(
-                db_connector=db_connector,
-                volume_from=config.volume_from,
-                volume_to=config.volume_to,
-                move_older_days=config.move_older_days,
-                uid=uid,
-                gid=gid,
-                dir_not_found=config.dir_not_found,
-                is_volume_to_network=config.is_volume_to_network,
-                is_dir_not_found_network=config.is_dir_not_found_network,
-            ).run()
-        sleep(60)
+            PolicyRunner(
+                create_apps(uid, gid),
+                max_runs_per_device=config.max_runs_per_device,
+            ).run(deadline=scheduled_run.deadline)
+    finally:
+        db_connector.close()
+        checksum_store.close()
+        journal.close()
+        uid_cache.close()
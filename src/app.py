@@ -1,19 +1,54 @@
+import heapq
 import logging
 import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from functools import partial
+from itertools import count, islice
+from typing import Any
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from datetime import datetime
 from enum import IntEnum
 
+from src.breaker import CircuitBreaker, is_transient_error, retry_delay
+from src.capacity import DiskUsage, dir_size
+from src.checksums import ChecksumStore
+from src.copier import CopyEngine, CopyResult, CopyStrategy, DEFAULT_STRATEGIES, VerifyMode, file_checksum
 from src.database import DatabaseConnector
 from src.dicom.exceptions import DicomError
 from src.dicom.service import DicomService
+from src.directories import DirectoryManager
 from src.exceptions import RemoveDirError, DBConnectError, DBExecuteQueryError, CopyFileError, RenameFileError, \
-    RemoveFileError
+    RemoveFileError, LinkFileError, CircuitOpenError
+from src.iohygiene import prefetch_file, evict_file_from_cache
+from src.journal import Journal, JournalEntry, JournalState
 from src.makstor.constants import MAKSTOR_UNREADABLE_PREFIX
 from src.makstor.repository import MakstorRepository
+from src.metrics import RunMetrics, Stage, load_last_run
+from src.planning import DirPlan, PlanReport
+from src.throttle import CopyThrottle, make_throttle
+from src.uid_cache import CachedUid, UidCache
 from src.utils import remove_dir, scan_directory, matches_date_pattern, extract_image_id_from_name, copy_file, \
-    rename_file, remove_file, extract_rel_path_from_abs_path, is_empty_dir
+    rename_file, remove_file, extract_rel_path_from_abs_path, is_empty_dir, link_file, is_same_filesystem, \
+    walk_files
 
 logger = logging.getLogger(__name__)
 
+# Количество id в одном пакетном запросе image из БД
+LOOKUP_CHUNK_SIZE = 1000
+# Количество image, обновляемых в БД одной транзакцией
+UPDATE_CHUNK_SIZE = 500
+# Суффикс временного имени копии, заменяющей отличающийся файл на целевом томе
+PARTIAL_SUFFIX = '.partial'
+
+# Имена в директориях для ненайденных, занятые начатыми переносами всех политик процесса
+_reserved_not_found_paths: set[str] = set()
+_reserved_not_found_lock = threading.Lock()
+
 
 class MoveFileStatus(IntEnum):
     MOVED = 0
@@ -23,6 +58,39 @@ class MoveFileStatus(IntEnum):
     NOT_FOUND_SKIPPED = 4
     NOT_FOUND_ONLY_COPIED = 5
     NOT_FOUND_ONLY_COPIED_AND_RENAMED = 6
+    # Временный сбой: файл будет перенесен повторно в этом же запуске
+    DEFERRED = 7
+    NOT_FOUND_DEFERRED = 8
+
+
+# Статус файла, повторы переноса которого исчерпаны
+EXHAUSTED_STATUSES = {
+    MoveFileStatus.DEFERRED: MoveFileStatus.SKIPPED,
+    MoveFileStatus.NOT_FOUND_DEFERRED: MoveFileStatus.NOT_FOUND_SKIPPED,
+}
+
+
+@dataclass
+class BatchImages:
+    """image пачки файлов, запрошенные из БД пакетными запросами"""
+    # По id из имени файла
+    by_id: dict[int, tuple | None] = field(default_factory=dict)
+    # По uid из DICOM файла, ключ - путь файла
+    by_path: dict[str, tuple | None] = field(default_factory=dict)
+
+
+@dataclass
+class PendingUpdate:
+    image_id: int
+    image_path: str
+    path_from: str
+    path_to: str
+    journal_id: int
+    # Скопировано байт и длительность копирования, сек. - для записи об итоге переноса
+    size: int = 0
+    duration: float = 0.0
+    # Копию создал этот запуск. Совпадавшая до переноса копия при откате не удаляется
+    is_copy_created: bool = True
 
 
 class FileSyncApp:
@@ -37,7 +105,37 @@ class FileSyncApp:
         gid: int,
         is_volume_to_network: bool,
         is_dir_not_found_network: bool,
+        workers: int = 1,
+        copy_strategies: tuple[CopyStrategy, ...] = DEFAULT_STRATEGIES,
+        verify_copy: VerifyMode = VerifyMode.off,
+        checksum_store: ChecksumStore | None = None,
+        journal: Journal | None = None,
+        uid_cache: UidCache | None = None,
+        metrics_dir: str | None = None,
+        throttle_bytes_per_s: float = 0,
+        throttle_files_per_s: float = 0,
+        throttle_adaptive: bool = False,
+        throttle_latency: float = 0.5,
+        name: str = 'default',
+        target_high_watermark: float = 95,
+        source_low_watermark: float = 0,
+        io_fadvise: bool = False,
+        file_records_level: int = logging.INFO,
+        chunked_copy_threshold: int = 0,
+        chunk_size: int = 64 * 1024 * 1024,
+        chunk_retries: int = 3,
+        db_breaker: CircuitBreaker | None = None,
+        volume_to_throttle: CopyThrottle | None = None,
+        dir_not_found_throttle: CopyThrottle | None = None,
+        volume_to_breaker: CircuitBreaker | None = None,
+        dir_not_found_breaker: CircuitBreaker | None = None,
+        breaker_failure_threshold: int = 5,
+        breaker_reset_timeout: float = 30,
+        retry_attempts: int = 3,
+        retry_delay: float = 10,
     ):
+        # Имя политики переноса
+        self.name = name
         self.volume_from = volume_from
         self.volume_from_path = ''
         self.volume_to = volume_to
@@ -48,18 +146,100 @@ class FileSyncApp:
         self.gid = gid
         self.is_volume_to_network = is_volume_to_network
         self.is_dir_not_found_network = is_dir_not_found_network
+        self.workers = max(workers, 1)
+        self.copy_engine = CopyEngine(copy_strategies, verify=verify_copy, evict_cache=io_fadvise)
+        # На сетевые тома большие файлы копируются по частям с продолжением после сбоя
+        self.network_copy_engine = CopyEngine(
+            copy_strategies, verify=verify_copy, evict_cache=io_fadvise,
+            chunked_threshold=chunked_copy_threshold, chunk_size=chunk_size, chunk_retries=chunk_retries,
+        )
+        # Предварительное чтение файлов из очереди и вытеснение скопированных из кеша
+        self.io_fadvise = io_fadvise
+        # Уровень записей лога об итоге переноса каждого файла (в JSON - с полями path, bytes, status...)
+        self.file_records_level = file_records_level
+        self.checksum_store = checksum_store
+        # Без файла журнала переносы журналируются в памяти только в рамках запуска
+        self.journal = journal or Journal()
+        self.uid_cache = uid_cache
+        # Подготовленные за запуск целевые директории
+        self.dir_manager = DirectoryManager()
+        # Длительность этапов переноса за запуск. Без metrics_dir метрики только пишутся в лог
+        self.metrics = RunMetrics()
+        self.metrics_dir = metrics_dir
+        # Заполненность (%) целевого тома, выше которой перенос не продолжается,
+        # и тома источника, ниже которой переносить больше не нужно
+        self.target_high_watermark = target_high_watermark
+        self.source_low_watermark = source_low_watermark
+        # Время, после которого новые файлы в перенос не берутся
+        self.deadline: datetime | None = None
+        # Ограничение копирования на сетевые тома, отдельное для каждого тома. Политики с общим томом
+        # получают общие ограничения и размыкатели (create_apps в main.py), иначе они создаются для политики
+        self.volume_to_throttle = volume_to_throttle or make_throttle(
+            f'целевой том {volume_to}', is_volume_to_network,
+            throttle_bytes_per_s, throttle_files_per_s, throttle_adaptive, throttle_latency,
+        )
+        self.dir_not_found_throttle = dir_not_found_throttle or make_throttle(
+            dir_not_found, is_dir_not_found_network,
+            throttle_bytes_per_s, throttle_files_per_s, throttle_adaptive, throttle_latency,
+        )
+        # Размыкатели цепи: при недоступности БД (общий для политик) или тома перенос приостанавливается,
+        # а не перебирает оставшиеся файлы с ошибками
+        self.db_breaker = db_breaker or CircuitBreaker('БД', breaker_failure_threshold, breaker_reset_timeout)
+        self.volume_to_breaker = volume_to_breaker or CircuitBreaker(
+            f'Целевой том {volume_to}', breaker_failure_threshold, breaker_reset_timeout)
+        self.dir_not_found_breaker = dir_not_found_breaker or CircuitBreaker(
+            dir_not_found, breaker_failure_threshold, breaker_reset_timeout)
+        # Файлы с временными сбоями переносятся повторно в конце директории с экспоненциальной паузой
+        self.retry_attempts = retry_attempts
+        self.retry_delay = retry_delay
+        self._retry_queue: list[tuple[float, int, os.DirEntry, MoveFileStatus]] = []
+        self._retry_counts: dict[str, int] = {}
+        self._retry_seq = count()
+        self._retry_lock = threading.Lock()
+        # Определяются при запуске: тома на одной файловой системе переносятся жесткими ссылками
+        self.is_volume_to_same_filesystem = False
+        self.is_dir_not_found_same_filesystem = False
         # repositories
         self.makstor_repository = MakstorRepository(db_connector)
+        # Скопированные файлы, ожидающие обновления в БД
+        self._pending_updates: list[PendingUpdate] = []
+        self._pending_updates_lock = threading.Lock()
 
-    @staticmethod
-    def _remove_dir(path: str):
+    @contextmanager
+    def _guarded(self, breaker: CircuitBreaker, is_deadline_bound: bool = True):
+        """Выполняет операцию с ресурсом через размыкатель цепи: ждет, пока ресурс доступен, и учитывает
+        результат. Любой ответ ресурса, кроме временной ошибки, считается его доступностью.
+        Если ресурс не восстановился до окончания окна, выбрасывает CircuitOpenError"""
+        if not breaker.wait(self.deadline if is_deadline_bound else None):
+            raise CircuitOpenError(f'Нет доступа до окончания окна переноса: {breaker.name}.')
         try:
-            remove_dir(path)
+            yield
+        except Exception as err:
+            if is_transient_error(err):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+
+    def _remove_dir(self, path: str):
+        try:
+            with self.metrics.measure(Stage.dir_remove):
+                remove_dir(path)
             logger.info(f'Директория {path} удалена.')
         except RemoveDirError as err:
             logger.error(f'Не удалось удалить пустую директорию: {path}. '
                          f'Ошибка: {err}')
 
+    def _remove_empty_dirs(self, path: str):
+        """Удаляет пустые поддиректории снизу вверх и саму директорию, если она опустела"""
+        for dir_path, _, file_names in os.walk(path, topdown=False):
+            if not file_names and is_empty_dir(dir_path):
+                self._remove_dir(dir_path)
+
     def _get_volume_path(self, volume_id: int) -> str | None:
         try:
             volume_path = self.makstor_repository.get_volume_path(volume_id)
@@ -70,169 +250,831 @@ class FileSyncApp:
             return
         return volume_path.strip()
 
+    def get_volume_devices(self) -> tuple[int | None, int | None]:
+        """Устройства тома источника и целевого тома, None - если том не найден или недоступен"""
+        devices = []
+        for volume_id in (self.volume_from, self.volume_to):
+            volume_path = self._get_volume_path(volume_id)
+            try:
+                devices.append(os.stat(volume_path).st_dev if volume_path else None)
+            except OSError:
+                devices.append(None)
+        return devices[0], devices[1]
+
     def _scan_volume(self, volume_path: str) -> list[os.DirEntry]:
         volume_dirs = scan_directory(
             volume_path,
             exclude_files=True,
             name_filter=lambda name: matches_date_pattern(name, self.move_older_days),
         )
-        return volume_dirs
+        # Старые директории первыми: прерванный по времени запуск продолжается следующим с того же места
+        return sorted(volume_dirs, key=lambda v_dir: v_dir.name)
+
+    def _copy_file(
+        self,
+        path_from: str,
+        path_to: str,
+        is_network: bool,
+        is_same_filesystem: bool,
+        throttle: CopyThrottle | None = None,
+    ) -> CopyResult | None:
+        """Копирует файл, а в пределах одной файловой системы создает жесткую ссылку без копирования данных.
+        Исходный файл в обоих случаях остается на месте до обновления в БД"""
+        # На сетевой том владелец не устанавливается
+        uid, gid = (None, None) if is_network else (self.uid, self.gid)
+        if is_same_filesystem:
+            try:
+                with self.metrics.measure(Stage.copy):
+                    link_file(path_from=path_from, path_to=path_to, uid=uid, gid=gid, dir_manager=self.dir_manager)
+                return None
+            except LinkFileError as err:
+                logger.debug('Не удалось создать жесткую ссылку %s -> %s, файл будет скопирован. Ошибка: %s',
+                             path_from, path_to, err)
+        if throttle:
+            try:
+                size = os.path.getsize(path_from)
+            except OSError:
+                size = 0
+            throttle.acquire(size)
+        start = time.perf_counter()
+        try:
+            result = copy_file(
+                path_from=path_from,
+                path_to=path_to,
+                uid=uid,
+                gid=gid,
+                copy_engine=self.network_copy_engine if is_network else self.copy_engine,
+                dir_manager=self.dir_manager,
+            )
+        except CopyFileError:
+            self.metrics.observe(Stage.copy, time.perf_counter() - start)
+            raise
+        duration = time.perf_counter() - start
+        self.metrics.observe(Stage.copy, duration, copied_bytes=result.size)
+        if throttle:
+            throttle.observe(duration, result.size)
+        logger.debug('Файл %s скопирован способом %s.', path_from, result.strategy, extra={
+            'path': path_from, 'path_to': path_to, 'bytes': result.size, 'duration_s': duration,
+            'strategy': result.strategy,
+        })
+        return result
+
+    def _is_identical_copy(self, path_from: str, path_to: str) -> bool | None:
+        """Сравнивает исходный файл с уже существующим файлом назначения по размеру и времени
+        модификации, а при включенной проверке копий - и по хешу.
+        None - файла назначения нет, True - он совпадает с исходным, False - отличается"""
+        try:
+            stat_to = os.stat(path_to)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            return False
+        try:
+            stat_from = os.stat(path_from)
+        except OSError:
+            return False
+        if os.path.samestat(stat_from, stat_to):
+            return True
+        if stat_from.st_size != stat_to.st_size or stat_from.st_mtime_ns != stat_to.st_mtime_ns:
+            return False
+        if self.copy_engine.verify == VerifyMode.off:
+            return True
+        checksum_to = self.checksum_store.get(path_to, stat_to) if self.checksum_store else None
+        try:
+            return file_checksum(path_from) == (checksum_to or file_checksum(path_to))
+        except OSError:
+            return False
+
+    def _prefetch_images(self, files: list[os.DirEntry], parse_dicom: bool = True) -> BatchImages:
+        """Пакетно запрашивает image из БД по id из имен файлов, а для файлов без id в имени
+        или не найденных по id - по uid из DICOM файлов"""
+        images = BatchImages()
+        image_ids = list({
+            image_id for file in files
+            if (image_id := extract_image_id_from_name(file.name))
+        })
+        for i in range(0, len(image_ids), LOOKUP_CHUNK_SIZE):
+            chunk = image_ids[i:i + LOOKUP_CHUNK_SIZE]
+            logger.debug('Пакетный запрос %d image по id из БД.', len(chunk))
+            try:
+                with self._guarded(self.db_breaker), self.metrics.measure(Stage.db_lookup):
+                    found_images = self.makstor_repository.get_images_by_ids(chunk)
+            except (DBConnectError, DBExecuteQueryError, CircuitOpenError) as err:
+                # Для этих id будет выполнен запрос по каждому файлу отдельно
+                logger.error(f'Не удалось выполнить пакетный запрос в БД. '
+                             f'Ошибка: {err}')
+                continue
+            for image_id in chunk:
+                images.by_id[image_id] = found_images.get(image_id)
+        if parse_dicom:
+            self._prefetch_images_by_uid(files, images)
+        return images
+
+    def _read_file_uid(self, file: os.DirEntry) -> tuple[os.stat_result | None, CachedUid | None, str | None]:
+        """Возвращает stat файла и запись кеша uid (если кеш включен) и uid из DICOM файла.
+        Неизменившиеся файлы из кеша повторно не читаются"""
+        stat = None
+        cached = None
+        if self.uid_cache:
+            try:
+                stat = file.stat(follow_symlinks=False)
+                cached = self.uid_cache.get(stat)
+            except OSError:
+                pass
+        if cached:
+            return stat, cached, cached.image_uid
+
+        logger.debug('Извлечение uid из файла %s.', file.name)
+        try:
+            with self.metrics.measure(Stage.dicom_parse):
+                image_uid = DicomService(file.path).get_image_uid()
+        except DicomError as err:
+            logger.error(f'Не удалось получить uid из файла {file.name}. '
+                         f'Ошибка: {err}')
+            image_uid = None
+        return stat, cached, image_uid
+
+    def _prefetch_images_by_uid(self, files: list[os.DirEntry], images: BatchImages):
+        """Пакетно запрашивает image по uid из DICOM файлов, не найденных по id из имени.
+        Файлы, для которых запрос не удался, ищутся в _move_file по одному"""
+        files_by_uid: dict[str, list[tuple[os.DirEntry, os.stat_result | None]]] = {}
+        for file in files:
+            image_id = extract_image_id_from_name(file.name)
+            if image_id and (image_id not in images.by_id or images.by_id[image_id]):
+                continue
+            stat, cached, image_uid = self._read_file_uid(file)
+            if cached and cached.lookup_at is not None:
+                images.by_path[file.path] = cached.image
+            elif image_uid is None:
+                if stat:
+                    self.uid_cache.put(stat, image_uid=None, is_looked_up=True)
+                images.by_path[file.path] = None
+            else:
+                files_by_uid.setdefault(image_uid, []).append((file, stat))
+
+        image_uids = list(files_by_uid)
+        for i in range(0, len(image_uids), LOOKUP_CHUNK_SIZE):
+            chunk = image_uids[i:i + LOOKUP_CHUNK_SIZE]
+            logger.debug('Пакетный запрос %d image по uid из БД.', len(chunk))
+            try:
+                with self._guarded(self.db_breaker), self.metrics.measure(Stage.db_lookup):
+                    found_images = self.makstor_repository.get_images_by_uids(chunk)
+            except (DBConnectError, DBExecuteQueryError, CircuitOpenError) as err:
+                logger.error(f'Не удалось выполнить пакетный запрос в БД. '
+                             f'Ошибка: {err}')
+                continue
+            for image_uid in chunk:
+                image = found_images.get(image_uid)
+                for file, stat in files_by_uid[image_uid]:
+                    images.by_path[file.path] = image
+                    if stat:
+                        self.uid_cache.put(stat, image_uid=image_uid, image=image, is_looked_up=True)
 
-    def _move_file(self, file: os.DirEntry) -> MoveFileStatus:
+    def _get_image_by_file_uid(self, file: os.DirEntry, images: BatchImages | None = None) -> tuple | None:
+        """Ищет image в БД по uid из DICOM файла: берет результат пакетного запроса или запрашивает по одному.
+        При наличии кеша uid результат запроса в БД используется до истечения его срока.
+        Временные ошибки БД выбрасываются, чтобы файл не был ошибочно перенесен в ненайденные"""
+        if images and file.path in images.by_path:
+            return images.by_path[file.path]
+        stat, cached, image_uid = self._read_file_uid(file)
+        if cached and cached.lookup_at is not None:
+            logger.debug('Результат поиска image для файла %s взят из кеша.', file.name)
+            return cached.image
+
+        if image_uid is None:
+            if stat:
+                self.uid_cache.put(stat, image_uid=None, is_looked_up=True)
+            return None
+
+        logger.debug('Запрос image по uid=%s.', image_uid)
+        try:
+            with self._guarded(self.db_breaker), self.metrics.measure(Stage.db_lookup):
+                image = self.makstor_repository.get_image_by_uid(image_uid)
+        except (DBConnectError, DBExecuteQueryError, CircuitOpenError) as err:
+            logger.error(f'Не удалось выполнить запрос в БД. '
+                         f'Ошибка: {err}')
+            if stat:
+                self.uid_cache.put(stat, image_uid=image_uid)
+            if is_transient_error(err):
+                raise
+            return None
+        if stat:
+            self.uid_cache.put(stat, image_uid=image_uid, image=image, is_looked_up=True)
+        return image
+
+    def _find_image_by_file_uid(self, file: os.DirEntry, images: BatchImages | None = None) -> tuple | None:
+        try:
+            return self._get_image_by_file_uid(file, images)
+        except (DBConnectError, CircuitOpenError):
+            return None
+
+    def _reserve_not_found_path(self, name: str) -> tuple[str, str]:
+        """Выбирает в директории для ненайденных свободное имя и занимает его до конца переноса.
+        Файлы с одинаковыми именами из разных поддиректорий получают суффикс _1, _2... и не перезаписывают
+        друг друга и уже перенесенные файлы. Возвращает итоговый путь и путь с префиксом для копирования"""
+        stem, ext = os.path.splitext(name)
+        with _reserved_not_found_lock:
+            for number in count():
+                candidate = f'{stem}_{number}{ext}' if number else name
+                path_to = str(os.path.join(self.dir_not_found, candidate))
+                # Использую префикс, для корректной работы авто-добавления из папки архивом
+                path_to_with_prefix = str(os.path.join(
+                    self.dir_not_found,
+                    f'{MAKSTOR_UNREADABLE_PREFIX}{candidate}',
+                ))
+                if (
+                    path_to in _reserved_not_found_paths
+                    or os.path.lexists(path_to)
+                    or os.path.lexists(path_to_with_prefix)
+                ):
+                    continue
+                _reserved_not_found_paths.add(path_to)
+                return path_to, path_to_with_prefix
+
+    def _move_not_found_file(self, file: os.DirEntry) -> MoveFileStatus:
+        """Переносит файл, для которого не найден image в БД, в директорию для ненайденных"""
+        path_to, path_to_with_prefix = self._reserve_not_found_path(file.name)
+        try:
+            return self._move_not_found_file_to(file, path_to, path_to_with_prefix)
+        finally:
+            with _reserved_not_found_lock:
+                _reserved_not_found_paths.discard(path_to)
+
+    def _move_not_found_file_to(self, file: os.DirEntry, path_to: str, path_to_with_prefix: str) -> MoveFileStatus:
+        path_from = file.path
+        logger.debug('Перемещение ненайденного image %s -> %s.', path_from, path_to_with_prefix)
+        journal_id = self.journal.plan(path_from=path_from, path_to=path_to, path_tmp=path_to_with_prefix)
+        start = time.perf_counter()
+        try:
+            with self._guarded(self.dir_not_found_breaker):
+                copy_result = self._copy_file(
+                    path_from=path_from,
+                    path_to=path_to_with_prefix,
+                    is_network=self.is_dir_not_found_network,
+                    is_same_filesystem=self.is_dir_not_found_same_filesystem,
+                    throttle=self.dir_not_found_throttle,
+                )
+            self.journal.mark(journal_id, JournalState.copied)
+            with self._guarded(self.dir_not_found_breaker, is_deadline_bound=False):
+                rename_file(path_to_with_prefix, path_to)
+            self.journal.mark(journal_id, JournalState.renamed)
+            with self.metrics.measure(Stage.unlink):
+                remove_file(file.path)
+            self.journal.mark(journal_id, JournalState.source_removed)
+            self._log_file_result(path_from, path_to, MoveFileStatus.NOT_FOUND_MOVED,
+                                  size=copy_result.size if copy_result else 0, duration=time.perf_counter() - start)
+            return MoveFileStatus.NOT_FOUND_MOVED
+        except (CopyFileError, CircuitOpenError) as err:
+            logger.error(f'Не удалось скопировать файл: '
+                         f'{path_from} -> {path_to_with_prefix}. '
+                         f'Ошибка: {err}')
+            # Неполная копия удаляется, чтобы повтор занял то же имя, а не следующее свободное
+            if os.path.lexists(path_to_with_prefix):
+                try:
+                    remove_file(path_to_with_prefix)
+                except RemoveFileError as remove_err:
+                    logger.error(f'Не удалось удалить неполную копию: {path_to_with_prefix}. '
+                                 f'Ошибка: {remove_err}')
+            self.journal.finish(journal_id)
+            if is_transient_error(err):
+                return MoveFileStatus.NOT_FOUND_DEFERRED
+            return MoveFileStatus.NOT_FOUND_SKIPPED
+        except RenameFileError as err:
+            logger.error(f'Не удалось переименовать файл: '
+                         f'{path_to_with_prefix} -> {path_to}. '
+                         f'Ошибка: {err}')
+            return MoveFileStatus.NOT_FOUND_ONLY_COPIED
+        except RemoveFileError as err:
+            logger.error(f'Не удалось удалить изначальный файл: {path_from}. '
+                         f'Ошибка: {err}')
+            return MoveFileStatus.NOT_FOUND_ONLY_COPIED_AND_RENAMED
+
+    def _move_file(
+        self,
+        file: os.DirEntry,
+        images: BatchImages | None = None,
+    ) -> MoveFileStatus | None:
+        """Переносит файл. Возвращает None, если файл скопирован и ожидает пакетного обновления в БД"""
         image = None
         is_use_image_path_from_db = False
 
-        logger.debug(f'Извлечение id из имени файла {file.name}.')
-        image_id_from_file = extract_image_id_from_name(file.name)
-        if image_id_from_file:
-            logger.debug(f'Запрос image по id={image_id_from_file} из БД.')
+        logger.debug('Извлечение id из имени файла %s.', file.name)
+        with self.metrics.measure(Stage.extract_id):
+            image_id_from_file = extract_image_id_from_name(file.name)
+        if image_id_from_file and images and image_id_from_file in images.by_id:
+            image = images.by_id[image_id_from_file]
+            if not image:
+                logger.debug('Не удалось получить image по id из БД.')
+        elif image_id_from_file:
+            logger.debug('Запрос image по id=%s из БД.', image_id_from_file)
             try:
-                image = self.makstor_repository.get_image_by_id(image_id_from_file)
+                with self._guarded(self.db_breaker), self.metrics.measure(Stage.db_lookup):
+                    image = self.makstor_repository.get_image_by_id(image_id_from_file)
                 if not image:
                     logger.debug('Не удалось получить image по id из БД.')
-            except (DBConnectError, DBExecuteQueryError) as err:
+            except (DBConnectError, DBExecuteQueryError, CircuitOpenError) as err:
                 logger.error(f'Не удалось выполнить запрос в БД. '
                              f'Ошибка: {err}')
-                return MoveFileStatus.SKIPPED
+                return MoveFileStatus.DEFERRED if is_transient_error(err) else MoveFileStatus.SKIPPED
         else:
             logger.debug('Не удалось извлечь id из имени файла.')
 
         if not image:
-            logger.debug(f'Извлечение uid из файла {file.name}.')
             try:
-                image_uid = DicomService(file.path).get_image_uid()
-                logger.debug(f'Запрос image по uid={image_uid}.')
-                image = self.makstor_repository.get_image_by_uid(image_uid)
-            except DicomError as err:
-                logger.error(f'Не удалось получить uid из файла {file.name}. '
-                             f'Ошибка: {err}')
-            except (DBConnectError, DBExecuteQueryError) as err:
-                logger.error(f'Не удалось выполнить запрос в БД. '
-                             f'Ошибка: {err}')
+                image = self._get_image_by_file_uid(file, images)
+            except (DBConnectError, CircuitOpenError):
+                return MoveFileStatus.DEFERRED
 
             if not image:
                 logger.error(f'Не удалось найти image {file.path} в БД.')
                 # В случае, если найден файл по uid использую отн. путь до файла из БД
                 # чтобы избежать дубликатов на целевом томе
                 is_use_image_path_from_db = True
-
-                path_from = file.path
-                path_to = str(os.path.join(
-                    self.dir_not_found,
-                    file.name,
-                ))
-                # Использую префикс, для корректной работы авто-добавления из папки архивом
-                path_to_with_prefix = str(os.path.join(
-                    self.dir_not_found,
-                    f'{MAKSTOR_UNREADABLE_PREFIX}{file.name}',
-                ))
-                logger.debug(f'Перемещение ненайденного image '
-                             f'{path_from} -> {path_to_with_prefix}.')
-                try:
-                    if self.is_dir_not_found_network:
-                        copy_file(
-                            path_from=path_from,
-                            path_to=path_to_with_prefix,
-                        )
-                    else:
-                        copy_file(
-                            path_from=path_from,
-                            path_to=path_to_with_prefix,
-                            uid=self.uid,
-                            gid=self.gid,
-                        )
-                    rename_file(path_to_with_prefix, path_to)
-                    remove_file(file.path)
-                    logger.debug(f'Файл успешно перемещен: {path_from} -> {path_to}.')
-                    return MoveFileStatus.NOT_FOUND_MOVED
-                except CopyFileError as err:
-                    logger.error(f'Не удалось скопировать файл: '
-                                 f'{path_from} -> {path_to_with_prefix}. '
-                                 f'Ошибка: {err}')
-                    return MoveFileStatus.NOT_FOUND_SKIPPED
-                except RenameFileError as err:
-                    logger.error(f'Не удалось переименовать файл: '
-                                 f'{path_to_with_prefix} -> {path_to}. '
-                                 f'Ошибка: {err}')
-                    return MoveFileStatus.NOT_FOUND_ONLY_COPIED
-                except RemoveFileError as err:
-                    logger.error(f'Не удалось удалить изначальный файл: {path_from}. '
-                                 f'Ошибка: {err}')
-                    return MoveFileStatus.NOT_FOUND_ONLY_COPIED_AND_RENAMED
+                return self._move_not_found_file(file)
 
         image_id = image[0]
 
         if is_use_image_path_from_db:
-            logger.debug(f'Используется путь до файла из БД.')
+            logger.debug('Используется путь до файла из БД.')
             image_rel_path = image[1]
         else:
-            logger.debug(f'Извлечение относительного пути из абсолютного. '
-                         f'base_path={self.volume_from_path}, abs_path={file.path}.')
+            logger.debug('Извлечение относительного пути из абсолютного. base_path=%s, abs_path=%s.',
+                         self.volume_from_path, file.path)
             image_rel_path = extract_rel_path_from_abs_path(
                 base_path=self.volume_from_path, abs_path=file.path)
 
         path_from = file.path
 
-        logger.debug(f'Получение абсолютного пути для файла. '
-                     f'volume_to_path={self.volume_to_path}, image_rel_path={image_rel_path}.')
+        logger.debug('Получение абсолютного пути для файла. volume_to_path=%s, image_rel_path=%s.',
+                     self.volume_to_path, image_rel_path)
         path_to = str(os.path.join(self.volume_to_path, image_rel_path))
 
         if not os.path.exists(path_from):
             logger.error(f'Файл {path_from} отсутствует.')
             return MoveFileStatus.SKIPPED
 
-        logger.debug(f'Перенос файла {path_from} -> {path_to}.')
+        logger.debug('Перенос файла %s -> %s.', path_from, path_to)
+
+        # Копия могла остаться от прерванного запуска: совпадающая не копируется повторно,
+        # отличающаяся заменяется копией под временным именем с атомарным переименованием
+        is_identical = self._is_identical_copy(path_from, path_to)
+        path_tmp = f'{path_to}{PARTIAL_SUFFIX}' if is_identical is False else None
+
+        journal_id = self.journal.plan(
+            path_from=path_from,
+            path_to=path_to,
+            path_tmp=path_tmp,
+            image_id=image_id,
+            share_uid=self.volume_to,
+            image_path=image_rel_path,
+            is_copy_created=not is_identical,
+        )
+        copy_result = None
+        start = time.perf_counter()
+        if is_identical:
+            logger.debug('Файл %s уже совпадает с %s, копирование пропущено.', path_to, path_from)
+        else:
+            try:
+                with self._guarded(self.volume_to_breaker):
+                    copy_result = self._copy_file(
+                        path_from=path_from,
+                        path_to=path_tmp or path_to,
+                        is_network=self.is_volume_to_network,
+                        is_same_filesystem=self.is_volume_to_same_filesystem,
+                        throttle=self.volume_to_throttle,
+                    )
+                    if path_tmp:
+                        rename_file(path_tmp, path_to)
+            except (CopyFileError, RenameFileError, CircuitOpenError) as err:
+                logger.error(f'Не удалось скопировать файл: {path_from} -> {path_to}. '
+                             f'Ошибка: {err}', extra={'path': path_from, 'path_to': path_to})
+                if path_tmp and os.path.exists(path_tmp):
+                    try:
+                        remove_file(path_tmp)
+                    except RemoveFileError as remove_err:
+                        logger.error(f'Не удалось удалить неполную копию: {path_tmp}. '
+                                     f'Ошибка: {remove_err}')
+                self.journal.finish(journal_id)
+                return MoveFileStatus.DEFERRED if is_transient_error(err) else MoveFileStatus.SKIPPED
+        self.journal.mark(journal_id, JournalState.copied)
 
+        if copy_result and copy_result.checksum and self.checksum_store:
+            self.checksum_store.put(path_to, copy_result.checksum)
+
+        # Обновление в БД и удаление исходного файла выполняются пакетно в _flush_updates
+        with self._pending_updates_lock:
+            self._pending_updates.append(PendingUpdate(
+                image_id=image_id,
+                image_path=image_rel_path,
+                path_from=path_from,
+                path_to=path_to,
+                journal_id=journal_id,
+                is_copy_created=not is_identical,
+                size=copy_result.size if copy_result else 0,
+                duration=time.perf_counter() - start,
+            ))
+        return None
+
+    def _log_file_result(self, path_from: str, path_to: str, status: MoveFileStatus, size: int, duration: float):
+        """Запись об итоге переноса файла на уровне file_records_level, в JSON формате - с полями файла"""
+        logger.log(self.file_records_level, 'Файл успешно перемещен: %s -> %s.', path_from, path_to, extra={
+            'path': path_from, 'path_to': path_to, 'bytes': size, 'duration_s': duration,
+            'status': status.name.lower(),
+        })
+
+    def _rollback_copy(self, update: PendingUpdate) -> MoveFileStatus:
+        path_to = update.path_to
         try:
-            if self.is_volume_to_network:
-                copy_file(
-                    path_from=path_from,
-                    path_to=path_to,
-                )
-            else:
-                copy_file(
-                    path_from=path_from,
-                    path_to=path_to,
-                    uid=self.uid,
-                    gid=self.gid,
-                )
-            self.makstor_repository.update_image(
-                image_id=image_id, share_uid=self.volume_to, image_path=image_rel_path)
-            remove_file(path_from)
-            logger.debug(f'Файл успешно перемещен: {path_from} -> {path_to}.')
-            return MoveFileStatus.MOVED
-        except CopyFileError as err:
-            logger.error(f'Не удалось скопировать файл: {path_from} -> {path_to}. '
-                         f'Ошибка: {err}')
+            if update.is_copy_created:
+                remove_file(path_to)
+            self.journal.finish(update.journal_id)
             return MoveFileStatus.SKIPPED
-        except (DBConnectError, DBExecuteQueryError) as err:
-            logger.error(f'Не удалось выполнить запрос в БД. '
+        except RemoveFileError as err:
+            logger.error(f'Не удалось удалить скопированный файл: {path_to}. '
                          f'Ошибка: {err}')
+            return MoveFileStatus.ONLY_COPIED
+
+    def _flush_updates(self, force: bool = True) -> list[MoveFileStatus]:
+        """Обновляет пакет image в БД одной транзакцией и только после фиксации удаляет исходные файлы.
+        Без force пакет отправляется, только если набран UPDATE_CHUNK_SIZE файлов"""
+        with self._pending_updates_lock:
+            if not force and len(self._pending_updates) < UPDATE_CHUNK_SIZE:
+                return []
+            pending, self._pending_updates = self._pending_updates, []
+        if not pending:
+            return []
+
+        logger.debug('Пакетное обновление %d image в БД.', len(pending))
+        rows = [(update.image_id, self.volume_to, update.image_path) for update in pending]
+        # Файлы пакета уже скопированы, поэтому при временных ошибках обновление повторяется
+        # и после окончания окна, а копии удаляются, только когда повторы исчерпаны
+        attempt = 0
+        while True:
             try:
-                remove_file(path_to)
-                return MoveFileStatus.SKIPPED
+                with self._guarded(self.db_breaker, is_deadline_bound=False), \
+                        self.metrics.measure(Stage.db_update):
+                    self.makstor_repository.update_images(rows)
+                break
+            except (DBConnectError, DBExecuteQueryError) as err:
+                logger.error(f'Не удалось выполнить запрос в БД. '
+                             f'Ошибка: {err}')
+                attempt += 1
+                if not is_transient_error(err) or attempt > self.retry_attempts:
+                    return [self._rollback_copy(update) for update in pending]
+                delay = retry_delay(attempt, self.retry_delay)
+                logger.info(f'Повтор обновления {len(pending)} image в БД через {delay:.0f} с.')
+                time.sleep(delay)
+        self.journal.mark([update.journal_id for update in pending], JournalState.db_updated)
+
+        if self.io_fadvise:
+            # К этому моменту копии пакета в основном записаны на носитель и их страницы можно вытеснить
+            for update in pending:
+                evict_file_from_cache(update.path_to)
+
+        statuses = []
+        for update in pending:
+            try:
+                with self.metrics.measure(Stage.unlink):
+                    remove_file(update.path_from)
+                self.journal.mark(update.journal_id, JournalState.source_removed)
+                self._log_file_result(update.path_from, update.path_to, MoveFileStatus.MOVED,
+                                      size=update.size, duration=update.duration)
+                statuses.append(MoveFileStatus.MOVED)
             except RemoveFileError as err:
-                logger.error(f'Не удалось удалить скопированный файл: {path_to}. '
+                logger.error(f'Не удалось удалить изначальный файл: {update.path_from}. '
                              f'Ошибка: {err}')
-                return MoveFileStatus.ONLY_COPIED
-        except RemoveFileError as err:
-            logger.error(f'Не удалось удалить изначальный файл: {path_from}. '
+                statuses.append(MoveFileStatus.ONLY_COPIED)
+        return statuses
+
+    def _replay_journal_entry(self, entry: JournalEntry):
+        # Копия image под временным именем переименовывается до перехода в copied
+        is_copy_renamed = entry.image_id is not None and entry.state != JournalState.planned
+        path_copy = entry.path_to if is_copy_renamed else entry.path_tmp or entry.path_to
+        source_exists = os.path.exists(entry.path_from)
+        copy_exists = os.path.exists(path_copy)
+
+        match entry.state:
+            case JournalState.planned:
+                # Копирование могло прерваться на середине - неполная копия удаляется,
+                # файл будет перенесен заново при сканировании. Копия, совпадавшая до переноса, остается
+                if source_exists and copy_exists and entry.is_copy_created:
+                    remove_file(path_copy)
+                logger.info(f'Откачен прерванный перенос {entry.path_from} -> {path_copy}.')
+            case JournalState.copied:
+                if not copy_exists or (source_exists and os.path.getsize(path_copy) != os.path.getsize(entry.path_from)):
+                    if copy_exists:
+                        remove_file(path_copy)
+                    logger.info(f'Откачен прерванный перенос {entry.path_from} -> {path_copy}: '
+                                f'копия отсутствует или не совпадает с исходным файлом.')
+                else:
+                    # Копия уже на месте - довожу перенос без повторного копирования
+                    if entry.image_id is None:
+                        rename_file(entry.path_tmp, entry.path_to)
+                    else:
+                        self.makstor_repository.update_images([(entry.image_id, entry.share_uid, entry.image_path)])
+                    if source_exists:
+                        remove_file(entry.path_from)
+                    logger.info(f'Завершен прерванный перенос {entry.path_from} -> {entry.path_to}.')
+            case JournalState.renamed | JournalState.db_updated:
+                if source_exists:
+                    remove_file(entry.path_from)
+                logger.info(f'Завершен прерванный перенос {entry.path_from} -> {entry.path_to}.')
+        self.journal.finish(entry.id)
+
+    def _replay_journal(self):
+        """Доводит или откатывает переносы, прерванные аварийным завершением прошлого запуска"""
+        entries = self.journal.unfinished(path_from_dir=self.volume_from_path)
+        if not entries:
+            return
+        logger.info(f'Найдено {len(entries)} незавершенных переносов в журнале.')
+        for entry in entries:
+            try:
+                self._replay_journal_entry(entry)
+            except (DBConnectError, DBExecuteQueryError) as err:
+                logger.error(f'Не удалось выполнить запрос в БД. '
+                             f'Ошибка: {err}')
+            except (RemoveFileError, RenameFileError) as err:
+                logger.error(f'Не удалось завершить прерванный перенос {entry.path_from} -> {entry.path_to}. '
+                             f'Ошибка: {err}')
+
+    def _target_usage(self) -> DiskUsage | None:
+        """Заполненность целевого тома. None - если место на нем не расходуется (жесткие ссылки)"""
+        if self.is_volume_to_same_filesystem:
+            return None
+        return DiskUsage.from_path(self.volume_to_path)
+
+    def _plan_dirs(self, volume_dirs: list[os.DirEntry]) -> Iterator[tuple[os.DirEntry, int]]:
+        """Выбирает директории (от старых к новым) и их размер, которые можно перенести,
+        не превысив заполненность целевого тома и не опустошая том источника ниже нужного.
+        Размер директории считается непосредственно перед ее переносом, а не для всего тома заранее"""
+        return self._select_dirs((v_dir, dir_size(v_dir.path)) for v_dir in volume_dirs)
+
+    def _select_dirs(self, dir_sizes: Iterable[tuple[Any, int]]) -> Iterator[tuple[Any, int]]:
+        """Выбирает из пар (директория, размер) первые, укладывающиеся в пороги заполненности томов.
+        Пары читаются по одной по мере выбора"""
+        try:
+            source_usage = DiskUsage.from_path(self.volume_from_path)
+            target_usage = self._target_usage()
+        except OSError as err:
+            logger.error(f'Не удалось получить заполненность томов, перенос без учета места. Ошибка: {err}')
+            yield from dir_sizes
+            return
+
+        num_planned = 0
+        planned_bytes = 0
+        for v_dir, size in dir_sizes:
+            if self.source_low_watermark and source_usage.used_percent(-planned_bytes) <= self.source_low_watermark:
+                logger.info(f'Заполненность тома источника после переноса будет не выше '
+                            f'{self.source_low_watermark}%, остальные директории не переносятся.')
+                break
+            if target_usage and target_usage.used_percent(planned_bytes + size) > self.target_high_watermark:
+                logger.warning(f'Перенос директории {v_dir.name} ({size} байт) превысит заполненность целевого тома '
+                               f'{self.target_high_watermark}%, остальные директории не переносятся.')
+                break
+            num_planned += 1
+            planned_bytes += size
+            logger.info(f'Выбрана для переноса директория {v_dir.name} ({size} байт), '
+                        f'всего выбрано {num_planned} директорий, {planned_bytes} байт.')
+            yield v_dir, size
+
+    def _has_target_space(self, size: int) -> bool:
+        """Проверяет перед директорией фактическое место на целевом томе: его могли занять другие записи"""
+        try:
+            target_usage = self._target_usage()
+        except OSError as err:
+            logger.error(f'Не удалось получить заполненность целевого тома. Ошибка: {err}')
+            return True
+        return not target_usage or target_usage.used_percent(size) <= self.target_high_watermark
+
+    def _is_deadline_reached(self) -> bool:
+        return self.deadline is not None and datetime.now() >= self.deadline
+
+    def _defer(self, file: os.DirEntry, status: MoveFileStatus) -> MoveFileStatus | None:
+        """Ставит файл с временным сбоем в очередь повторов. Возвращает итоговый статус, если повторы исчерпаны"""
+        with self._retry_lock:
+            attempt = self._retry_counts.get(file.path, 0) + 1
+            if attempt > self.retry_attempts:
+                logger.error(f'Повторы переноса файла {file.path} исчерпаны.')
+                return EXHAUSTED_STATUSES[status]
+            self._retry_counts[file.path] = attempt
+            due = time.monotonic() + retry_delay(attempt, self.retry_delay)
+            heapq.heappush(self._retry_queue, (due, next(self._retry_seq), file, status))
+        logger.debug('Файл %s будет перенесен повторно (попытка %d).', file.path, attempt)
+        return None
+
+    def _take_retries(self, statuses: Counter) -> list[tuple[os.DirEntry, MoveFileStatus]]:
+        """Ждет первого файла из очереди повторов и забирает все файлы, пауза которых истекла, вместе
+        с их статусом. После окончания окна оставшиеся в очереди файлы учитываются как пропущенные"""
+        with self._retry_lock:
+            if not self._retry_queue:
+                return []
+            due = self._retry_queue[0][0]
+        wait = due - time.monotonic()
+        if self.deadline is not None:
+            wait = min(wait, (self.deadline - datetime.now()).total_seconds())
+        if wait > 0:
+            logger.info(f'В очереди повторов {len(self._retry_queue)} файлов, повтор через {wait:.0f} с.')
+            time.sleep(wait)
+        with self._retry_lock:
+            if self._is_deadline_reached():
+                logger.info(f'Наступило время окончания окна, {len(self._retry_queue)} файлов из очереди повторов '
+                            f'будут перенесены при следующем запуске.')
+                statuses.update(EXHAUSTED_STATUSES[status] for *_, status in self._retry_queue)
+                self._retry_queue.clear()
+                return []
+            files = []
+            now = time.monotonic()
+            while self._retry_queue and self._retry_queue[0][0] <= now:
+                _, _, file, status = heapq.heappop(self._retry_queue)
+                files.append((file, status))
+        return files
+
+    def _process_file(self, file: os.DirEntry, images: BatchImages) -> list[MoveFileStatus]:
+        statuses = []
+        moved_status = self._move_file(file, images)
+        if moved_status in EXHAUSTED_STATUSES:
+            moved_status = self._defer(file, moved_status)
+        if moved_status is not None:
+            statuses.append(moved_status)
+        statuses.extend(self._flush_updates(force=False))
+        return statuses
+
+    def _failed_file_status(self, file: os.DirEntry) -> MoveFileStatus:
+        """Статус файла, перенос которого прерван непредвиденной ошибкой. Скопированный файл исключается
+        из пакетного обновления и остается в журнале, перенос доводится при следующем запуске"""
+        with self._pending_updates_lock:
+            pending = [update for update in self._pending_updates if update.path_from == file.path]
+            for update in pending:
+                self._pending_updates.remove(update)
+        return MoveFileStatus.ONLY_COPIED if pending else MoveFileStatus.SKIPPED
+
+    def _iter_batches(
+        self, files: Iterable[os.DirEntry], parse_dicom: bool = True,
+    ) -> Iterable[tuple[os.DirEntry, BatchImages]]:
+        """Читает файлы пачками по LOOKUP_CHUNK_SIZE и возвращает каждый файл вместе с image пачки,
+        запрошенными из БД пакетными запросами. В памяти одновременно не больше одной пачки"""
+        files = iter(files)
+        while batch := list(islice(files, LOOKUP_CHUNK_SIZE)):
+            images = self._prefetch_images(batch, parse_dicom)
+            for file in batch:
+                yield file, images
+
+    def _process_files(self, files: Iterable[os.DirEntry]) -> Counter:
+        """Переносит файлы по мере их чтения, затем файлы с временными сбоями из очереди повторов,
+        и возвращает количество файлов по статусам"""
+        statuses = Counter()
+        self._retry_counts.clear()
+        retry_statuses: dict[str, MoveFileStatus] = {}
+        while files:
+            self._process_batch(files, statuses, retry_statuses)
+            # Повторы, не начатые до окончания окна, учитываются как пропущенные
+            statuses.update(EXHAUSTED_STATUSES[status] for status in retry_statuses.values())
+            retries = self._take_retries(statuses)
+            files = [file for file, _ in retries]
+            retry_statuses = {file.path: status for file, status in retries}
+        statuses.update(self._flush_updates())
+        return statuses
+
+    def _process_batch(self, files: Iterable[os.DirEntry], statuses: Counter, unstarted: dict[str, MoveFileStatus]):
+        """Переносит файлы до окончания окна. Начатые файлы удаляются из unstarted (путь - статус повтора)"""
+        statuses_lock = threading.Lock()
+
+        if self.workers == 1:
+            batches = self._iter_batches(files)
+            current = next(batches, None)
+            while current is not None:
+                if self._is_deadline_reached():
+                    break
+                following = next(batches, None)
+                # Следующий файл читается в кеш, пока копируется текущий
+                if following and self.io_fadvise:
+                    prefetch_file(following[0].path)
+                unstarted.pop(current[0].path, None)
+                statuses.update(self._process_file(*current))
+                current = following
+        else:
+            # Ограничивает очередь задач, чтобы не создавать future на все файлы директории сразу
+            queue_slots = threading.BoundedSemaphore(self.workers * 2)
+
+            def on_done(file: os.DirEntry, future: Future):
+                queue_slots.release()
+                if future.exception():
+                    logger.error(f'Ошибка при переносе файла {file.path}. Ошибка: {future.exception()}')
+                    with statuses_lock:
+                        statuses[self._failed_file_status(file)] += 1
+                    return
+                with statuses_lock:
+                    statuses.update(future.result())
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'{self.name}-worker') as executor:
+                for file, images in self._iter_batches(files):
+                    # Файл будет скопирован после уже стоящих в очереди - запускаю его чтение заранее
+                    if self.io_fadvise:
+                        prefetch_file(file.path)
+                    queue_slots.acquire()
+                    if self._is_deadline_reached():
+                        queue_slots.release()
+                        break
+                    unstarted.pop(file.path, None)
+                    executor.submit(self._process_file, file, images).add_done_callback(partial(on_done, file))
+
+    def _write_metrics(self):
+        self.metrics.finish()
+        stages = [(stage, histogram) for stage, histogram in self.metrics.run.stages.items() if histogram.count]
+        if stages:
+            logger.info(
+                'Длительность этапов (всего, сек; p99, сек): ' + ', '.join(
+                    f'{stage} {histogram.sum:.1f}; {histogram.percentile(99):.3f}' for stage, histogram in stages
+                ) + f'. Скопировано байт: {self.metrics.run.copied_bytes}.'
+            )
+        if not self.metrics_dir:
+            return
+        try:
+            self.metrics.write(self.metrics_dir, name=f'filesync-{self.name}', labels={'policy': self.name})
+        except OSError as err:
+            logger.error(f'Не удалось сохранить метрики в {self.metrics_dir}. '
                          f'Ошибка: {err}')
-            return MoveFileStatus.ONLY_COPIED
 
-    def run(self):
+    def run(self, deadline: datetime | None = None, replay_journal: bool = True):
+        """Переносит файлы. После deadline новые файлы не берутся, начатые переносы завершаются.
+        Без replay_journal журнал прерванных переносов должен быть разобран заранее (replay_journal)"""
+        self.deadline = deadline
+        self.dir_manager = DirectoryManager()
+        self.metrics = RunMetrics()
+        try:
+            self._run(replay_journal)
+        finally:
+            self._write_metrics()
+
+    def replay_journal(self):
+        """Разбирает журнал прерванных переносов тома источника. Журнал общий для политик процесса,
+        поэтому при параллельной работе политик он разбирается до их запуска: иначе запись начатого
+        другой политикой переноса была бы принята за оставшуюся после сбоя"""
+        if self._prepare_volumes():
+            self._replay_journal()
+
+    def _prepare_volumes(self) -> bool:
+        """Получает пути томов из БД и определяет, находятся ли они на одной файловой системе"""
         logger.debug(f'Получение путь до тома источника uid={self.volume_from}.')
         self.volume_from_path = self._get_volume_path(self.volume_from)
         if not self.volume_from_path:
             logger.error(f'Не удалось найти том источника с uid={self.volume_from}.')
-            return
+            return False
 
         logger.debug(f'Получение путь до целевого тома uid={self.volume_to}.')
         self.volume_to_path = self._get_volume_path(self.volume_to)
         if not self.volume_to_path:
             logger.error(f'Не удалось найти целевой том с uid={self.volume_to}.')
+            return False
+
+        self.is_volume_to_same_filesystem = is_same_filesystem(self.volume_from_path, self.volume_to_path)
+        self.is_dir_not_found_same_filesystem = is_same_filesystem(self.volume_from_path, self.dir_not_found)
+        return True
+
+    def plan(self, parse_dicom: bool = False, deadline: datetime | None = None) -> PlanReport:
+        """Пробный прогон без копирования и обновлений в БД: считает по директориям файлы и объем,
+        находит image пакетными запросами по id из имен и оценивает длительность переноса.
+        DICOM файлы без id в имени разбираются только с parse_dicom"""
+        report = PlanReport(policy=self.name, is_dicom_parsed=parse_dicom, deadline=deadline)
+        if not self._prepare_volumes():
+            return report
+
+        for v_dir in self._scan_volume(self.volume_from_path):
+            dir_plan = DirPlan(name=v_dir.name)
+            for file, images in self._iter_batches(walk_files(v_dir.path), parse_dicom):
+                try:
+                    size = file.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+                dir_plan.files += 1
+                dir_plan.bytes += size
+                if images.by_id.get(extract_image_id_from_name(file.name)):
+                    dir_plan.resolved += 1
+                elif parse_dicom and self._find_image_by_file_uid(file, images):
+                    dir_plan.resolved_by_uid += 1
+                else:
+                    dir_plan.unresolved += 1
+                    dir_plan.unresolved_bytes += size
+            report.dirs.append(dir_plan)
+
+        selected = {id(dir_plan) for dir_plan, _ in self._select_dirs((plan, plan.bytes) for plan in report.dirs)}
+        for dir_plan in report.dirs:
+            dir_plan.is_skipped = id(dir_plan) not in selected
+        if self.metrics_dir:
+            report.estimate(load_last_run(self.metrics_dir, f'filesync-{self.name}'))
+        return report
+
+    def _run(self, replay_journal: bool = True):
+        if not self._prepare_volumes():
             return
 
+        if replay_journal:
+            self._replay_journal()
+
+        if self.is_volume_to_same_filesystem:
+            logger.info('Том источника и целевой том на одной файловой системе, '
+                        'файлы переносятся без копирования данных.')
+
         logger.info(f'Сканирование тома источника {self.volume_from_path}.')
         volume_from_dirs = self._scan_volume(self.volume_from_path)
         if not volume_from_dirs:
@@ -242,62 +1084,52 @@ class FileSyncApp:
         logger.info(f'Найдено {len(volume_from_dirs)} директорий.')
         logger.debug(', '.join(v_dir.name for v_dir in volume_from_dirs))
 
-        for v_dir in volume_from_dirs:
-            logger.info(f'Сканирование директории {v_dir.name}.')
-            dir_files = scan_directory(
-                v_dir.path,
-                exclude_dirs=True,
-            )
+        planned_dirs = self._plan_dirs(volume_from_dirs)
 
-            if not dir_files:
-                logger.info('Не найдено файлов для переноса. Удаление директории...')
-                self._remove_dir(v_dir.path)
-                continue
+        run_statuses = Counter()
+
+        for v_dir, size in planned_dirs:
+            if self._is_deadline_reached():
+                logger.info(f'Наступило время окончания окна {self.deadline:%H:%M}, перенос остановлен. '
+                            f'Оставшиеся файлы будут перенесены при следующем запуске.')
+                break
+            if not self._has_target_space(size):
+                logger.warning(f'Недостаточно места на целевом томе для директории {v_dir.name} ({size} байт) '
+                               f'с учетом порога {self.target_high_watermark}%, перенос остановлен.')
+                break
+            logger.info(f'Перенос файлов директории {v_dir.name}.')
+            self.metrics.begin_dir(v_dir.name)
 
-            num_all_files = len(dir_files)
-
-            logger.info(f'Найдено {num_all_files} файлов.')
-
-            num_moved_files = 0
-            num_skipped_files = 0
-            num_only_copied_files = 0
-            num_not_found_moved_files = 0
-            num_not_found_skipped_files = 0
-            num_not_found_only_copied_files = 0
-            num_not_found_only_copied_and_renamed_files = 0
-
-            for d_file in dir_files:
-                moved_status = self._move_file(d_file)
-                match moved_status:
-                    # Base
-                    case MoveFileStatus.MOVED:
-                        num_moved_files += 1
-                    case MoveFileStatus.SKIPPED:
-                        num_skipped_files += 1
-                    case MoveFileStatus.ONLY_COPIED:
-                        num_only_copied_files += 1
-                    # Not found
-                    case MoveFileStatus.NOT_FOUND_MOVED:
-                        num_not_found_moved_files += 1
-                    case MoveFileStatus.NOT_FOUND_SKIPPED:
-                        num_not_found_skipped_files += 1
-                    case MoveFileStatus.NOT_FOUND_ONLY_COPIED:
-                        num_not_found_only_copied_files += 1
-                    case MoveFileStatus.NOT_FOUND_ONLY_COPIED_AND_RENAMED:
-                        num_not_found_only_copied_and_renamed_files += 1
-
-            # Если после переноса папка осталось пустой - удаляю
-            if is_empty_dir(v_dir.path):
-                self._remove_dir(v_dir.path)
+            # Файлы переносятся по мере обхода директории и поддиректорий
+            statuses = self._process_files(walk_files(v_dir.path))
+            run_statuses.update(statuses)
+            self.metrics.add_statuses(statuses)
+            num_all_files = statuses.total()
+
+            # Опустевшие после переноса поддиректории и саму директорию удаляю
+            self._remove_empty_dirs(v_dir.path)
+
+            if not num_all_files:
+                logger.info(f'Не найдено файлов для переноса в директории {v_dir.name}.')
+                continue
 
             logger.info(
                 f'Всего файлов: {num_all_files} в директории {v_dir.name}. Из них:\n'
-                f'Перемещено: {num_moved_files}\n'
-                f'Только скопировано: {num_only_copied_files}\n'
-                f'Пропущено: {num_skipped_files}\n'
+                f'Перемещено: {statuses[MoveFileStatus.MOVED]}\n'
+                f'Только скопировано: {statuses[MoveFileStatus.ONLY_COPIED]}\n'
+                f'Пропущено: {statuses[MoveFileStatus.SKIPPED]}\n'
                 f'Для ненайденных файлов в БД:\n'
-                f'Перемещено: {num_not_found_moved_files}\n'
-                f'Только скопировано: {num_not_found_only_copied_files}\n'
-                f'Только скопировано и переименовано: {num_not_found_only_copied_and_renamed_files}\n'
-                f'Пропущено: {num_not_found_skipped_files}\n'
+                f'Перемещено: {statuses[MoveFileStatus.NOT_FOUND_MOVED]}\n'
+                f'Только скопировано: {statuses[MoveFileStatus.NOT_FOUND_ONLY_COPIED]}\n'
+                f'Только скопировано и переименовано: '
+                f'{statuses[MoveFileStatus.NOT_FOUND_ONLY_COPIED_AND_RENAMED]}\n'
+                f'Пропущено: {statuses[MoveFileStatus.NOT_FOUND_SKIPPED]}\n'
             )
+
+        num_moved_files = run_statuses[MoveFileStatus.MOVED] + run_statuses[MoveFileStatus.NOT_FOUND_MOVED]
+        logger.info(
+            f'Перенос завершен. Перемещено: {num_moved_files}, '
+            f'из них ненайденных в БД: {run_statuses[MoveFileStatus.NOT_FOUND_MOVED]}, '
+            f'не перемещено: {run_statuses.total() - num_moved_files}.\n'
+            f'Кеш целевых директорий: попаданий {self.dir_manager.hits}, промахов {self.dir_manager.misses}.'
+        )
@@ -0,0 +1,131 @@
+import errno
+import logging
+import threading
+import time
+
+from datetime import datetime
+from enum import StrEnum
+
+from src.exceptions import DBConnectError, CopyFileError, RenameFileError, RemoveFileError, ChecksumMismatchError, \
+    CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Ошибки ввода-вывода, после которых операция может пройти повторно: том или сеть временно недоступны
+TRANSIENT_ERRNOS = frozenset({
+    errno.EIO,
+    errno.EAGAIN,
+    errno.EINTR,
+    errno.EBUSY,
+    errno.ETIMEDOUT,
+    errno.ESTALE,
+    errno.ENOTCONN,
+    errno.ECONNRESET,
+    errno.ECONNABORTED,
+    errno.ECONNREFUSED,
+    errno.ENETDOWN,
+    errno.ENETUNREACH,
+    errno.ENETRESET,
+    errno.EHOSTDOWN,
+    errno.EHOSTUNREACH,
+    errno.EREMOTEIO,
+})
+# Максимальная пауза между повторами, сек.
+MAX_RETRY_DELAY = 600
+
+
+def is_transient_error(err: BaseException) -> bool:
+    """Временная ли ошибка: потеря соединения с БД или сбой ввода-вывода сетевого тома.
+    Ошибки запросов, отсутствие файлов, нехватка места и несовпадение копии считаются постоянными"""
+    if isinstance(err, (DBConnectError, CircuitOpenError)):
+        return True
+    if isinstance(err, ChecksumMismatchError):
+        return False
+    if isinstance(err, (CopyFileError, RenameFileError, RemoveFileError)) and err.args:
+        err = err.args[0]
+    return isinstance(err, OSError) and err.errno in TRANSIENT_ERRNOS
+
+
+def retry_delay(attempt: int, base_delay: float) -> float:
+    """Экспоненциальная пауза перед повтором номер attempt (с 1)"""
+    return min(base_delay * 2 ** (attempt - 1), MAX_RETRY_DELAY)
+
+
+class BreakerState(StrEnum):
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold временных ошибок подряд, после чего операции не выполняются,
+    а ждут. Через reset_timeout сек. пропускается одна пробная операция: успех замыкает цепь,
+    ошибка снова размыкает ее с удвоенным (до max_reset_timeout) временем ожидания"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30,
+                 max_reset_timeout: float = MAX_RETRY_DELAY):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(max_reset_timeout, reset_timeout)
+        self.state = BreakerState.closed
+        self.failures = 0
+        self._timeout = reset_timeout
+        self._opened_at = 0.0
+        self._is_probing = False
+        self._condition = threading.Condition()
+
+    def _allow(self) -> bool:
+        if self.state == BreakerState.closed:
+            return True
+        if self.state == BreakerState.open and time.monotonic() - self._opened_at >= self._timeout:
+            self.state = BreakerState.half_open
+        if self.state == BreakerState.half_open and not self._is_probing:
+            self._is_probing = True
+            return True
+        return False
+
+    def wait(self, deadline: datetime | None = None) -> bool:
+        """Ждет, пока операции разрешены. False - если раньше наступил deadline"""
+        with self._condition:
+            while not self._allow():
+                if deadline is not None and datetime.now() >= deadline:
+                    return False
+                timeout = max(self._timeout - (time.monotonic() - self._opened_at), 0.1)
+                if deadline is not None:
+                    timeout = min(timeout, max((deadline - datetime.now()).total_seconds(), 0.1))
+                self._condition.wait(timeout)
+            return True
+
+    def record_success(self):
+        with self._condition:
+            if self.state != BreakerState.closed:
+                logger.info(f'Доступ восстановлен: {self.name}, перенос продолжен.')
+            self.state = BreakerState.closed
+            self.failures = 0
+            self._timeout = self.reset_timeout
+            self._is_probing = False
+            self._condition.notify_all()
+
+    def record_failure(self):
+        """Учитывает временную ошибку"""
+        with self._condition:
+            self.failures += 1
+            if self.state == BreakerState.half_open:
+                self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+            elif self.state == BreakerState.open or self.failures < self.failure_threshold:
+                # Ошибки операций, начатых до размыкания, срок ожидания не продлевают
+                return
+            self.state = BreakerState.open
+            self._opened_at = time.monotonic()
+            self._is_probing = False
+            logger.warning(f'{self.name}: {self.failures} ошибок подряд, перенос приостановлен. '
+                           f'Следующая попытка через {self._timeout:.0f} с.')
+            self._condition.notify_all()
+
+    def release(self):
+        """Завершает пробную операцию, не давшую результата (например, прерванную по другой причине)"""
+        with self._condition:
+            if self._is_probing:
+                self._is_probing = False
+                self._condition.notify_all()
@@ -0,0 +1,34 @@
+import os
+
+from dataclasses import dataclass
+
+from src.utils import walk_files
+
+
+@dataclass
+class DiskUsage:
+    # Размер файловой системы и место, доступное для записи, байт
+    total: int
+    available: int
+
+    @classmethod
+    def from_path(cls, path: str) -> 'DiskUsage':
+        stat = os.statvfs(path)
+        return cls(total=stat.f_blocks * stat.f_frsize, available=stat.f_bavail * stat.f_frsize)
+
+    def used_percent(self, delta: int = 0) -> float:
+        """Заполненность в процентах после записи (delta > 0) или удаления (delta < 0) delta байт"""
+        if not self.total:
+            return 100.0
+        return (self.total - self.available + delta) / self.total * 100
+
+
+def dir_size(path: str) -> int:
+    """Суммарный размер файлов директории и поддиректорий по закешированному в DirEntry stat"""
+    size = 0
+    for file in walk_files(path):
+        try:
+            size += file.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return size
@@ -0,0 +1,58 @@
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ChecksumStore:
+    """Хранит хеши скопированных файлов для повторного использования в следующих запусках.
+    Хеш действителен, пока у файла не изменились размер и время модификации"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute('pragma synchronous=normal')
+        self._conn.execute(
+            """create table if not exists checksums (
+                path text primary key,
+                size integer not null,
+                mtime_ns integer not null,
+                checksum text not null
+            )"""
+        )
+
+    def get(self, path: str, stat: os.stat_result | None = None) -> str | None:
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'select checksum from checksums where path = ? and size = ? and mtime_ns = ?',
+                (path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, path: str, checksum: str, stat: os.stat_result | None = None):
+        try:
+            stat = stat or os.stat(path)
+        except OSError as e:
+            logger.debug(f'Не удалось сохранить хеш файла {path}. Ошибка: {e}')
+            return
+        with self._lock:
+            self._conn.execute(
+                'insert or replace into checksums (path, size, mtime_ns, checksum) values (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, checksum),
+            )
+
+    def remove(self, path: str):
+        with self._lock:
+            self._conn.execute('delete from checksums where path = ?', (path,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -5,29 +5,66 @@ from datetime import datetime
 from dataclasses import dataclass
 from enum import StrEnum
 
+from src.copier import CopyStrategy, VerifyMode
 from src.exceptions import ConfigError
-from src.logger import LogLevels
+from src.logger import LogLevels, LogFormat
+from src.scheduler import RunWindow
 
 
 @dataclass
-class ConfigData:
-    # Options
-    start_time: datetime.time
-    move_older_days: int
+class PolicyConfig:
+    name: str
     volume_from: int
     volume_to: int
-    is_dir_not_found_network: bool
+    move_older_days: int
+    dir_not_found: str
     is_volume_to_network: bool
+    is_dir_not_found_network: bool
+    target_high_watermark: float
+    source_low_watermark: float
+
+
+@dataclass
+class ConfigData:
+    # Options
+    schedule: list[RunWindow]
+    policies: list[PolicyConfig]
+    max_runs_per_device: int
     log_level: LogLevels
-    dir_not_found: str
+    log_format: LogFormat
+    log_file_records_level: LogLevels
+    log_max_mb: int
+    log_backup_count: int
+    log_rotate_when: str
     owner_name: str
     group_name: str
+    workers: int
+    copy_strategies: tuple[CopyStrategy, ...]
+    verify_copy: VerifyMode
+    uid_cache_size: int
+    uid_cache_lookup_ttl_hours: int
+    metrics_dir: str
+    throttle_mb_per_s: float
+    throttle_files_per_s: float
+    throttle_adaptive: bool
+    throttle_latency_ms: int
+    io_fadvise: bool
+    io_idle_priority: bool
+    io_nice: int
+    chunked_copy_threshold_mb: int
+    chunk_size_mb: int
+    chunk_retries: int
+    breaker_failure_threshold: int
+    breaker_reset_s: int
+    retry_attempts: int
+    retry_delay_s: int
     # Database
     db_name: str
     db_user: str
     db_password: str
     db_host: str
     db_port: int
+    db_pool_size: int
 
 
 class ConfigSection(StrEnum):
@@ -35,6 +72,10 @@ class ConfigSection(StrEnum):
     database = 'Database'
 
 
+# Секции политик переноса: [Policy:<имя>]
+POLICY_SECTION_PREFIX = 'Policy:'
+
+
 class Config:
     def __init__(self, ini: str, encoding: str = 'utf-8'):
         self._encoding = encoding
@@ -55,6 +96,95 @@ class Config:
         except ValueError:
             raise ConfigError(f'{section}:{option} - {time_str} время указано некорректно. Формат: %H:%M.')
 
+    def get_copy_strategies(self, section: str, option: str, fallback: str = None) -> tuple[CopyStrategy, ...]:
+        strategies_str = self.config.get(section, option, fallback=fallback)
+        try:
+            strategies = tuple(CopyStrategy(name.strip()) for name in strategies_str.split(',') if name.strip())
+        except ValueError:
+            raise ConfigError(f'{section}:{option} - {strategies_str} неизвестный способ копирования. '
+                              f'Допустимые: {", ".join(CopyStrategy)}.')
+        if not strategies:
+            raise ConfigError(f'{section}:{option} - не указан ни один способ копирования.')
+        return strategies
+
+    def get_verify_mode(self, section: str, option: str, fallback: str = None) -> VerifyMode:
+        mode_str = self.config.get(section, option, fallback=fallback)
+        try:
+            return VerifyMode(mode_str.strip().lower())
+        except ValueError:
+            raise ConfigError(f'{section}:{option} - {mode_str} неизвестный режим проверки. '
+                              f'Допустимые: {", ".join(VerifyMode)}.')
+
+    def get_log_format(self, section: str, option: str, fallback: str = None) -> LogFormat:
+        format_str = self.config.get(section, option, fallback=fallback)
+        try:
+            return LogFormat(format_str.strip().lower())
+        except ValueError:
+            raise ConfigError(f'{section}:{option} - {format_str} неизвестный формат лога. '
+                              f'Допустимые: {", ".join(LogFormat)}.')
+
+    def get_log_level(self, section: str, option: str, fallback: str = None) -> LogLevels:
+        level_str = self.config.get(section, option, fallback=fallback)
+        try:
+            return LogLevels(level_str.strip().upper())
+        except ValueError:
+            raise ConfigError(f'{section}:{option} - {level_str} неизвестный уровень лога. '
+                              f'Допустимые: {", ".join(level.name for level in LogLevels)}.')
+
+    def get_schedule(self, section: str, option: str, fallback_start_time: datetime.time) -> list[RunWindow]:
+        """Окна запуска через ';'. Если расписание не задано, перенос запускается ежедневно в start_time"""
+        schedule_str = self.config.get(section, option, fallback='').strip()
+        if not schedule_str:
+            schedule_str = f'{fallback_start_time.minute} {fallback_start_time.hour} * * *'
+        try:
+            return [RunWindow.parse(window) for window in schedule_str.split(';') if window.strip()]
+        except ValueError as err:
+            raise ConfigError(f'{section}:{option} - некорректное окно запуска: {err}.')
+
+    def get_policy(self, section: str, name: str) -> PolicyConfig:
+        """Политика переноса из секции section. Незаданные параметры берутся из [Options]"""
+        def option_section(option: str) -> str:
+            return section if self.config.has_option(section, option) else ConfigSection.options
+
+        try:
+            return PolicyConfig(
+                name=name,
+                volume_from=self.config.getint(
+                    option_section('volume_from'), 'volume_from'),
+                volume_to=self.config.getint(
+                    option_section('volume_to'), 'volume_to'),
+                move_older_days=self.config.getint(
+                    option_section('move_older_days'), 'move_older_days', fallback=30),
+                dir_not_found=self.get_path(
+                    option_section('dir_not_found'), 'dir_not_found'),
+                is_volume_to_network=self.config.getboolean(
+                    option_section('is_volume_to_network'), 'is_volume_to_network', fallback=False),
+                is_dir_not_found_network=self.config.getboolean(
+                    option_section('is_dir_not_found_network'), 'is_dir_not_found_network', fallback=False),
+                target_high_watermark=self.config.getfloat(
+                    option_section('target_high_watermark'), 'target_high_watermark', fallback=95),
+                source_low_watermark=self.config.getfloat(
+                    option_section('source_low_watermark'), 'source_low_watermark', fallback=0),
+            )
+        except (configparser.Error, ValueError) as err:
+            raise ConfigError(f'{section} - некорректная политика переноса: {err}.')
+
+    def get_policies(self) -> list[PolicyConfig]:
+        """Политики из секций [Policy:<имя>], без них - одна политика из [Options]"""
+        policy_sections = [
+            section for section in self.config.sections() if section.startswith(POLICY_SECTION_PREFIX)
+        ]
+        if not policy_sections:
+            return [self.get_policy(ConfigSection.options, 'default')]
+        policies = [
+            self.get_policy(section, section.removeprefix(POLICY_SECTION_PREFIX).strip())
+            for section in policy_sections
+        ]
+        names = [policy.name for policy in policies]
+        if len(set(names)) != len(names) or not all(names):
+            raise ConfigError('Имена политик переноса должны быть непустыми и уникальными.')
+        return policies
+
     def read(self) -> ConfigData:
         self.config.read(self.ini, encoding=self._encoding)
 
@@ -62,24 +192,66 @@ class Config:
             # Options
             log_level=self.config.get(
                 ConfigSection.options, 'log_level', fallback=LogLevels.info),
-            start_time=self.get_time(
-                ConfigSection.options, 'start_time', fallback='00:00'),
-            move_older_days=self.config.getint(
-                ConfigSection.options, 'move_older_days', fallback=30),
-            dir_not_found=self.get_path(
-                ConfigSection.options, 'dir_not_found'),
-            volume_from=self.config.getint(
-                ConfigSection.options, 'volume_from'),
-            volume_to=self.config.getint(
-                ConfigSection.options, 'volume_to'),
-            is_dir_not_found_network=self.config.getboolean(
-                ConfigSection.options, 'is_dir_not_found_network', fallback=False),
-            is_volume_to_network=self.config.getboolean(
-                ConfigSection.options, 'is_volume_to_network', fallback=False),
+            log_format=self.get_log_format(
+                ConfigSection.options, 'log_format', fallback=LogFormat.text),
+            log_file_records_level=self.get_log_level(
+                ConfigSection.options, 'log_file_records_level', fallback=LogLevels.info),
+            log_max_mb=self.config.getint(
+                ConfigSection.options, 'log_max_mb', fallback=100),
+            log_backup_count=self.config.getint(
+                ConfigSection.options, 'log_backup_count', fallback=5),
+            log_rotate_when=self.config.get(
+                ConfigSection.options, 'log_rotate_when', fallback=''),
+            schedule=self.get_schedule(
+                ConfigSection.options, 'schedule',
+                fallback_start_time=self.get_time(ConfigSection.options, 'start_time', fallback='00:00')),
+            policies=self.get_policies(),
+            max_runs_per_device=self.config.getint(
+                ConfigSection.options, 'max_runs_per_device', fallback=1),
             owner_name=self.config.get(
                 ConfigSection.options, 'owner_name', fallback='makstor'),
             group_name=self.config.get(
                 ConfigSection.options, 'group_name', fallback='makhaon'),
+            workers=self.config.getint(
+                ConfigSection.options, 'workers', fallback=1),
+            copy_strategies=self.get_copy_strategies(
+                ConfigSection.options, 'copy_strategies', fallback=','.join(CopyStrategy)),
+            verify_copy=self.get_verify_mode(
+                ConfigSection.options, 'verify_copy', fallback=VerifyMode.off),
+            uid_cache_size=self.config.getint(
+                ConfigSection.options, 'uid_cache_size', fallback=100000),
+            uid_cache_lookup_ttl_hours=self.config.getint(
+                ConfigSection.options, 'uid_cache_lookup_ttl_hours', fallback=168),
+            metrics_dir=self.config.get(
+                ConfigSection.options, 'metrics_dir', fallback=''),
+            throttle_mb_per_s=self.config.getfloat(
+                ConfigSection.options, 'throttle_mb_per_s', fallback=0),
+            throttle_files_per_s=self.config.getfloat(
+                ConfigSection.options, 'throttle_files_per_s', fallback=0),
+            throttle_adaptive=self.config.getboolean(
+                ConfigSection.options, 'throttle_adaptive', fallback=False),
+            throttle_latency_ms=self.config.getint(
+                ConfigSection.options, 'throttle_latency_ms', fallback=500),
+            io_fadvise=self.config.getboolean(
+                ConfigSection.options, 'io_fadvise', fallback=True),
+            io_idle_priority=self.config.getboolean(
+                ConfigSection.options, 'io_idle_priority', fallback=False),
+            io_nice=self.config.getint(
+                ConfigSection.options, 'io_nice', fallback=0),
+            chunked_copy_threshold_mb=self.config.getint(
+                ConfigSection.options, 'chunked_copy_threshold_mb', fallback=1024),
+            chunk_size_mb=self.config.getint(
+                ConfigSection.options, 'chunk_size_mb', fallback=64),
+            chunk_retries=self.config.getint(
+                ConfigSection.options, 'chunk_retries', fallback=3),
+            breaker_failure_threshold=self.config.getint(
+                ConfigSection.options, 'breaker_failure_threshold', fallback=5),
+            breaker_reset_s=self.config.getint(
+                ConfigSection.options, 'breaker_reset_s', fallback=30),
+            retry_attempts=self.config.getint(
+                ConfigSection.options, 'retry_attempts', fallback=3),
+            retry_delay_s=self.config.getint(
+                ConfigSection.options, 'retry_delay_s', fallback=10),
             # Database
             db_name=self.config.get(
                 ConfigSection.database, 'name'),
@@ -91,4 +263,6 @@ class Config:
                 ConfigSection.database, 'host'),
             db_port=self.config.getint(
                 ConfigSection.database, 'port'),
+            db_pool_size=self.config.getint(
+                ConfigSection.database, 'pool_size', fallback=2),
         )
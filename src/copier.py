@@ -0,0 +1,336 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from dataclasses import dataclass
+from enum import StrEnum
+
+from src.exceptions import ChecksumMismatchError
+from src.iohygiene import evict_from_cache
+
+logger = logging.getLogger(__name__)
+
+# ioctl клонирования файла (reflink) на btrfs/XFS
+FICLONE = 0x40049409
+BUFFER_SIZE = 8 * 1024 * 1024
+# Максимальный объем одного вызова copy_file_range/sendfile
+CHUNK_SIZE = 1024 * 1024 * 1024
+# Суффиксы недокопированного по частям файла и файла с ходом его копирования
+PART_SUFFIX = '.part'
+PROGRESS_SUFFIX = '.progress'
+# Максимальная пауза между повторами копирования по частям, сек.
+MAX_RETRY_DELAY = 30
+
+# Ошибки, означающие что способ копирования не поддерживается для этой пары файловых систем
+UNSUPPORTED_ERRNOS = {
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EBADF,
+}
+
+
+class CopyStrategy(StrEnum):
+    reflink = 'reflink'
+    copy_file_range = 'copy_file_range'
+    sendfile = 'sendfile'
+    buffer = 'buffer'
+
+
+class VerifyMode(StrEnum):
+    # Без проверки
+    off = 'off'
+    # Хеш считается при копировании, у копии проверяется размер
+    inline = 'inline'
+    # Дополнительно копия перечитывается с носителя в обход кеша и сверяется по хешу
+    readback = 'readback'
+
+
+@dataclass
+class CopyResult:
+    strategy: CopyStrategy
+    checksum: str | None = None
+    # Объем скопированных данных, байт
+    size: int = 0
+
+
+def new_hasher():
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_checksum(path: str, drop_cache: bool = False) -> str:
+    """Считает хеш файла. С drop_cache страницы файла предварительно вытесняются из кеша,
+    чтобы данные были прочитаны с носителя"""
+    hasher = new_hasher()
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        fd = file.fileno()
+        if drop_cache:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while read := file.readinto(buffer):
+            hasher.update(view[:read])
+    return hasher.hexdigest()
+
+
+def _copy_reflink(fd_from: int, fd_to: int):
+    fcntl.ioctl(fd_to, FICLONE, fd_from)
+
+
+def _copy_file_range(fd_from: int, fd_to: int):
+    offset = 0
+    while copied := os.copy_file_range(fd_from, fd_to, CHUNK_SIZE, offset, offset):
+        offset += copied
+
+
+def _copy_sendfile(fd_from: int, fd_to: int):
+    offset = 0
+    while sent := os.sendfile(fd_to, fd_from, offset, CHUNK_SIZE):
+        offset += sent
+
+
+def _copy_buffer(fd_from: int, fd_to: int, hasher=None):
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(fd_from, 'rb', buffering=0, closefd=False) as file_from:
+        while read := file_from.readinto(buffer):
+            if hasher:
+                hasher.update(view[:read])
+            written = 0
+            while written < read:
+                written += os.write(fd_to, view[written:read])
+
+
+_STRATEGY_FUNCTIONS = {
+    CopyStrategy.reflink: _copy_reflink,
+    CopyStrategy.copy_file_range: _copy_file_range,
+    CopyStrategy.sendfile: _copy_sendfile,
+    CopyStrategy.buffer: _copy_buffer,
+}
+
+DEFAULT_STRATEGIES = tuple(CopyStrategy)
+
+
+class CopyEngine:
+    """Копирует данные файла, перебирая способы от самого дешевого к универсальному.
+    Неподдерживаемые способы запоминаются для пары устройств и больше не пробуются"""
+
+    def __init__(
+        self,
+        strategies: tuple[CopyStrategy, ...] = DEFAULT_STRATEGIES,
+        verify: VerifyMode = VerifyMode.off,
+        evict_cache: bool = False,
+        chunked_threshold: int = 0,
+        chunk_size: int = 64 * 1024 * 1024,
+        chunk_retries: int = 3,
+    ):
+        self.strategies = strategies
+        self.verify = verify
+        # Файлы от chunked_threshold байт (0 - никакие) копируются по частям с продолжением после сбоя
+        self.chunked_threshold = chunked_threshold
+        self.chunk_size = chunk_size
+        self.chunk_retries = chunk_retries
+        # Вытеснять исходный файл и копию из кеша после копирования, чтобы не вытеснять горячие данные PACS
+        self.evict_cache = evict_cache
+        self._unsupported: set[tuple[int, int, CopyStrategy]] = set()
+        self._lock = threading.Lock()
+
+    def copy(self, path_from: str, path_to: str) -> CopyResult:
+        """Копирует содержимое и метаданные (как shutil.copy2), возвращает использованный способ
+        и, если включена проверка, хеш данных"""
+        if self.chunked_threshold and os.path.getsize(path_from) >= self.chunked_threshold:
+            result = self._copy_chunked(path_from, path_to)
+        elif self.verify != VerifyMode.off:
+            result = self._copy_verified(path_from, path_to)
+        else:
+            with open(path_from, 'rb', buffering=0) as file_from, open(path_to, 'wb', buffering=0) as file_to:
+                fd_from = file_from.fileno()
+                fd_to = file_to.fileno()
+                stat_from = os.fstat(fd_from)
+                devices = (stat_from.st_dev, os.fstat(fd_to).st_dev)
+                result = CopyResult(strategy=self._copy_data(fd_from, fd_to, devices), size=stat_from.st_size)
+                if self.evict_cache:
+                    evict_from_cache(fd_from)
+                    evict_from_cache(fd_to)
+        shutil.copystat(path_from, path_to)
+        return result
+
+    def _copy_chunked(self, path_from: str, path_to: str) -> CopyResult:
+        """Копирует файл частями по chunk_size в path_to.part, записывая после каждой части ее хеш
+        в path_to.part.progress. После сбоя (в том же вызове до chunk_retries раз или в следующем запуске)
+        копирование продолжается с конца последней записанной части. В итоговое имя файл переименовывается,
+        только когда размер и хеши всех частей, перечитанных из копии, совпадают с исходным файлом"""
+        part_path = f'{path_to}{PART_SUFFIX}'
+        progress_path = f'{part_path}{PROGRESS_SUFFIX}'
+        attempt = 0
+        while True:
+            try:
+                chunks = self._copy_chunks(path_from, part_path, progress_path)
+                break
+            except OSError as e:
+                attempt += 1
+                if attempt > self.chunk_retries:
+                    raise
+                delay = min(2 ** attempt, MAX_RETRY_DELAY)
+                logger.warning(f'Сбой копирования {path_from} по частям, повтор {attempt} через {delay} с. '
+                               f'Ошибка: {e}')
+                time.sleep(delay)
+
+        error, checksum = self._verify_chunks(path_from, part_path, chunks)
+        if error:
+            for path in (part_path, progress_path):
+                os.remove(path)
+            raise ChecksumMismatchError(f'{path_from} -> {path_to}: {error}')
+        os.replace(part_path, path_to)
+        os.remove(progress_path)
+        return CopyResult(
+            strategy=CopyStrategy.buffer,
+            checksum=checksum if self.verify != VerifyMode.off else None,
+            size=chunks[-1][0] if chunks else 0,
+        )
+
+    @staticmethod
+    def _read_progress(progress_path: str, stat_from: os.stat_result) -> list[tuple[int, str]]:
+        """Части (смещение конца, хеш), записанные прошлыми попытками. Если исходный файл с тех пор
+        изменился, копирование начинается заново"""
+        try:
+            with open(progress_path, encoding='utf-8') as progress:
+                header = progress.readline().split()
+                if header != [str(stat_from.st_size), str(stat_from.st_mtime_ns)]:
+                    return []
+                chunks = []
+                for line in progress:
+                    offset, digest = line.split()
+                    chunks.append((int(offset), digest))
+                return chunks
+        except (OSError, ValueError):
+            return []
+
+    def _copy_chunks(self, path_from: str, part_path: str, progress_path: str) -> list[tuple[int, str]]:
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        with open(path_from, 'rb', buffering=0) as file_from:
+            fd_from = file_from.fileno()
+            stat_from = os.fstat(fd_from)
+            chunks = self._read_progress(progress_path, stat_from)
+            # Часть засчитывается, только если ее данные есть в копии
+            part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            while chunks and chunks[-1][0] > part_size:
+                chunks.pop()
+            offset = chunks[-1][0] if chunks else 0
+            if offset:
+                logger.info(f'Продолжение копирования {path_from} по частям с {offset} байт.')
+
+            with open(part_path, 'r+b' if part_size else 'wb', buffering=0) as file_to, \
+                    open(progress_path, 'w', encoding='utf-8') as progress:
+                fd_to = file_to.fileno()
+                progress.write(f'{stat_from.st_size} {stat_from.st_mtime_ns}\n')
+                progress.writelines(f'{end} {digest}\n' for end, digest in chunks)
+                progress.flush()
+                os.ftruncate(fd_to, offset)
+                os.lseek(fd_from, offset, os.SEEK_SET)
+                os.lseek(fd_to, offset, os.SEEK_SET)
+                while read := file_from.readinto(buffer):
+                    written = 0
+                    while written < read:
+                        written += os.write(fd_to, view[written:read])
+                    # Часть записывается в ход копирования только после сброса ее данных на том
+                    os.fdatasync(fd_to)
+                    offset += read
+                    digest = new_hasher()
+                    digest.update(view[:read])
+                    chunks.append((offset, digest.hexdigest()))
+                    progress.write(f'{offset} {chunks[-1][1]}\n')
+                    progress.flush()
+                    if self.evict_cache:
+                        evict_from_cache(fd_from)
+                        evict_from_cache(fd_to)
+        return chunks
+
+    @staticmethod
+    def _verify_chunks(
+        path_from: str, part_path: str, chunks: list[tuple[int, str]],
+    ) -> tuple[str | None, str | None]:
+        """Перечитывает копию с носителя и сверяет размер и хеши частей.
+        Возвращает описание расхождения и хеш всей копии"""
+        size_from = os.path.getsize(path_from)
+        size_to = os.path.getsize(part_path)
+        if size_from != size_to or (chunks[-1][0] if chunks else 0) != size_from:
+            return f'Размер копии {size_to} не совпадает с размером исходного файла {size_from}', None
+        checksum = new_hasher()
+        with open(part_path, 'rb', buffering=0) as file_to:
+            fd_to = file_to.fileno()
+            evict_from_cache(fd_to)
+            start = 0
+            for end, digest in chunks:
+                hasher = new_hasher()
+                remaining = end - start
+                while remaining and (data := file_to.read(min(remaining, BUFFER_SIZE))):
+                    hasher.update(data)
+                    checksum.update(data)
+                    remaining -= len(data)
+                if remaining or hasher.hexdigest() != digest:
+                    return f'Хеш части {start}-{end} копии не совпадает с хешем исходного файла', None
+                start = end
+            evict_from_cache(fd_to)
+        return None, checksum.hexdigest()
+
+    def _copy_verified(self, path_from: str, path_to: str) -> CopyResult:
+        """Копирует данные через буфер, считая хеш по ходу копирования без повторного чтения источника"""
+        hasher = new_hasher()
+        with open(path_from, 'rb', buffering=0) as file_from, open(path_to, 'wb', buffering=0) as file_to:
+            fd_from = file_from.fileno()
+            fd_to = file_to.fileno()
+            _copy_buffer(fd_from, fd_to, hasher)
+            size_from = os.fstat(fd_from).st_size
+            size_to = os.fstat(fd_to).st_size
+            if self.verify == VerifyMode.readback:
+                os.fsync(fd_to)
+            if self.evict_cache:
+                evict_from_cache(fd_from)
+                evict_from_cache(fd_to)
+        checksum = hasher.hexdigest()
+
+        error = None
+        if size_from != size_to:
+            error = f'Размер копии {size_to} не совпадает с размером исходного файла {size_from}'
+        elif self.verify == VerifyMode.readback and file_checksum(path_to, drop_cache=True) != checksum:
+            error = 'Хеш копии не совпадает с хешем исходного файла'
+        if error:
+            os.remove(path_to)
+            raise ChecksumMismatchError(f'{path_from} -> {path_to}: {error}')
+        return CopyResult(strategy=CopyStrategy.buffer, checksum=checksum, size=size_to)
+
+    def _copy_data(self, fd_from: int, fd_to: int, devices: tuple[int, int]) -> CopyStrategy:
+        for strategy in self.strategies:
+            if (*devices, strategy) in self._unsupported:
+                continue
+            try:
+                _STRATEGY_FUNCTIONS[strategy](fd_from, fd_to)
+                # Некоторые ФС возвращают 0 из copy_file_range/sendfile, не скопировав данные
+                if strategy == CopyStrategy.buffer or os.fstat(fd_to).st_size == os.fstat(fd_from).st_size:
+                    return strategy
+                raise OSError(errno.ENOTSUP, 'Размер копии не совпадает с исходным файлом')
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or strategy == CopyStrategy.buffer:
+                    raise
+                logger.debug(f'Способ копирования {strategy} не поддерживается. Ошибка: {e}')
+                with self._lock:
+                    self._unsupported.add((*devices, strategy))
+                # Начинаю копирование заново следующим способом
+                os.ftruncate(fd_to, 0)
+                os.lseek(fd_to, 0, os.SEEK_SET)
+                os.lseek(fd_from, 0, os.SEEK_SET)
+        raise OSError(errno.ENOTSUP, 'Нет доступного способа копирования')
+
+
+default_copy_engine = CopyEngine()
@@ -1,7 +1,13 @@
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
 
 import psycopg2
-from psycopg2._psycopg import cursor
+from psycopg2._psycopg import cursor as pg_cursor, connection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 from src.exceptions import DBExecuteQueryError, DBConnectError
 
@@ -9,45 +15,215 @@ logger = logging.getLogger(__name__)
 
 
 class DatabaseConnector:
-    def __init__(self, dbname: str, user: str, password: str, host: str, port: int):
+    # Соединение, простаивавшее дольше этого времени (сек.), проверяется перед выдачей
+    health_check_interval = 30
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, port: int, pool_size: int = 1):
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.pool_size = max(pool_size, 1)
 
-        self.conn = None
-        self.cursor = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Ограничивает число одновременно выданных соединений, чтобы потоки ждали, а не падали с PoolError
+        self._pool_semaphore = threading.BoundedSemaphore(self.pool_size)
+        self._last_used: dict[int, float] = {}
+        # У каждого потока свое соединение и своя транзакция
+        self._local = threading.local()
 
-    def __enter__(self):
+    @property
+    def conn(self) -> connection | None:
+        return getattr(self._local, 'conn', None)
+
+    @property
+    def cursor(self) -> pg_cursor | None:
+        return getattr(self._local, 'cursor', None)
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        with self._pool_lock:
+            if self._pool is None:
+                try:
+                    self._pool = ThreadedConnectionPool(
+                        minconn=1,
+                        maxconn=self.pool_size,
+                        dbname=self.dbname,
+                        user=self.user,
+                        password=self.password,
+                        host=self.host,
+                        port=self.port,
+                    )
+                except psycopg2.OperationalError as e:
+                    logger.debug(f'Ошибка подключения к БД. Исключение: {e}')
+                    raise DBConnectError(str(e))
+            return self._pool
+
+    def _is_alive(self, conn: connection) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        # Новое соединение или недавно использованное не проверяю лишним запросом
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
         try:
-            self.conn = psycopg2.connect(
-                dbname=self.dbname,
-                user=self.user,
-                password=self.password,
-                host=self.host,
-                port=self.port
-            )
-        except psycopg2.OperationalError as e:
-            logger.debug(f'Ошибка подключения к БД. Исключение: {e}')
-            raise DBConnectError(str(e))
-        self.cursor = self.conn.cursor()
+            with conn.cursor() as cur:
+                cur.execute('select 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.debug(f'Соединение с БД неработоспособно. Исключение: {e}')
+            return False
+
+    def _acquire(self) -> connection:
+        pool = self._get_pool()
+        # Одна попытка на каждое соединение в пуле + одна на новое
+        for _ in range(self.pool_size + 1):
+            try:
+                conn = pool.getconn()
+            except psycopg2.OperationalError as e:
+                logger.debug(f'Ошибка подключения к БД. Исключение: {e}')
+                raise DBConnectError(str(e))
+            if self._is_alive(conn):
+                # Вне transaction() запросы выполняются в autocommit: без BEGIN и ROLLBACK на каждый запрос
+                conn.autocommit = True
+                return conn
+            logger.debug('Переподключение к БД.')
+            self._discard(conn)
+        raise DBConnectError('Не удалось получить рабочее соединение с БД.')
+
+    def _discard(self, conn: connection):
+        self._last_used.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except psycopg2.Error:
+            pass
+
+    def _release(self, conn: connection, broken: bool = False):
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        try:
+            # Соединение возвращается в пул без открытой транзакции. В autocommit откат без транзакции
+            # к серверу не обращается
+            conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn)
+
+    def __enter__(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._pool_semaphore.acquire()
+            try:
+                conn = self._acquire()
+            except Exception:
+                self._pool_semaphore.release()
+                raise
+            self._local.conn = conn
+            self._local.cursor = conn.cursor()
+            self._local.broken = False
+            self._local.in_transaction = False
+        self._local.depth = depth + 1
         return self
 
-    def execute(self, query: str, params=None) -> cursor | None:
+    @contextmanager
+    def transaction(self):
+        """Выполняет запросы в одной транзакции с фиксацией в конце блока"""
+        with self as db:
+            if self._local.in_transaction:
+                yield db
+                return
+            self._local.in_transaction = True
+            try:
+                self.conn.autocommit = False
+                yield db
+                try:
+                    self.conn.commit()
+                except Exception as e:
+                    self._raise_query_error('commit', None, e)
+            except Exception:
+                if not self._local.broken:
+                    try:
+                        self.conn.rollback()
+                    except psycopg2.Error:
+                        self._local.broken = True
+                raise
+            finally:
+                self._local.in_transaction = False
+                if not self._local.broken:
+                    try:
+                        self.conn.autocommit = True
+                    except psycopg2.Error:
+                        self._local.broken = True
+
+    def _raise_query_error(self, query: str, params, e: Exception):
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            # Соединение потеряно - не возвращаю его в пул
+            logger.debug(f'Потеряно соединение с БД при выполнении запроса: {query}. Исключение: {e}')
+            self._local.broken = True
+            raise DBConnectError(str(e))
+        logger.debug(f'Ошибка выполнения запроса: {query} с параметрами: {params}. Исключение: {e}')
+        self.conn.rollback()
+        raise DBExecuteQueryError(str(e))
+
+    def execute(self, query: str, params=None) -> pg_cursor | None:
         try:
             self.cursor.execute(query, params)
             if query.strip().lower().startswith('select'):
                 return self.cursor
-            else:
+            elif not self._local.in_transaction:
                 self.conn.commit()
         except Exception as e:
-            logger.debug(f'Ошибка выполнения запроса: {query} с параметрами: {params}. Исключение: {e}')
-            self.conn.rollback()
-            raise DBExecuteQueryError(str(e))
+            self._raise_query_error(query, params, e)
+
+    def execute_values(self, query: str, rows: list[tuple], page_size: int = 100):
+        """Выполняет запрос с VALUES %s для множества строк за один проход"""
+        try:
+            execute_values(self.cursor, query, rows, page_size=page_size)
+            if not self._local.in_transaction:
+                self.conn.commit()
+        except Exception as e:
+            self._raise_query_error(query, f'{len(rows)} строк', e)
+
+    def stream(self, query: str, params=None, name: str = 'stream', itersize: int = 10000) -> Iterator[tuple]:
+        """Построчно читает результат запроса серверным (именованным) курсором пачками по itersize строк,
+        не загружая весь результат в память. Соединение занято, пока генератор не исчерпан или не закрыт"""
+        with self.transaction():
+            cursor = self.conn.cursor(name=name)
+            cursor.itersize = itersize
+            try:
+                cursor.execute(query, params)
+                yield from cursor
+            except psycopg2.Error as e:
+                self._raise_query_error(query, params, e)
+            finally:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    pass
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        conn = self._local.conn
+        try:
+            self._local.cursor.close()
+        except psycopg2.Error:
+            pass
+        self._release(conn, broken=self._local.broken)
+        self._local.conn = None
+        self._local.cursor = None
+        self._pool_semaphore.release()
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
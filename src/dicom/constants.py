@@ -0,0 +1,2 @@
+# (0008,0018) SOPInstanceUID
+SOP_INSTANCE_UID_TAG = '00080018'
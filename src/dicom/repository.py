@@ -1,19 +1,35 @@
 import pydicom
+from pydicom.filereader import read_partial
+from pydicom.tag import Tag
 
 from src.dicom.exceptions import DicomError, TagNotFoundError
 
 
 class DicomRepository:
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, tags: list[str] | None = None):
         self.file_path = file_path
+        # Если указаны теги - читается только заголовок до последнего из них
+        self.tags = [Tag(tag) for tag in tags] if tags else None
         self.file = self.load_dicom_file()
 
     def load_dicom_file(self):
         try:
+            if self.tags:
+                return self._load_dicom_tags()
             return pydicom.dcmread(self.file_path)
         except Exception as e:
             raise DicomError(f'Ошибка при загрузке DICOM файла: {e}')
 
+    def _load_dicom_tags(self):
+        """Читает только указанные теги и прекращает разбор файла, как только они пройдены"""
+        last_tag = max(self.tags)
+        with open(self.file_path, 'rb') as fp:
+            return read_partial(
+                fp,
+                stop_when=lambda tag, vr, length: tag > last_tag,
+                specific_tags=self.tags,
+            )
+
     def get_tag(self, tag: str):
         if tag in self.file:
             return self.file[tag].value
@@ -1,9 +1,11 @@
+from src.dicom.constants import SOP_INSTANCE_UID_TAG
 from src.dicom.repository import DicomRepository
 
 
 class DicomService:
     def __init__(self, file_path: str):
-        self.repository = DicomRepository(file_path)
+        # Сервису нужен только SOPInstanceUID - пиксельные данные и остальной датасет не читаются
+        self.repository = DicomRepository(file_path, tags=[SOP_INSTANCE_UID_TAG])
 
     def get_image_uid(self):
-        return self.repository.get_tag('00080018')
+        return self.repository.get_tag(SOP_INSTANCE_UID_TAG)
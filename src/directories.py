@@ -0,0 +1,28 @@
+import os
+import threading
+
+
+class DirectoryManager:
+    """Создает целевые директории и устанавливает их владельца один раз за запуск.
+    Повторные обращения к уже подготовленной директории не выполняют операций с ФС"""
+
+    def __init__(self):
+        self._ready: set[tuple[str, int | None, int | None]] = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ensure(self, path: str, uid: int | None = None, gid: int | None = None):
+        key = (path, uid, gid)
+        with self._lock:
+            if key in self._ready:
+                self.hits += 1
+                return
+            self.misses += 1
+        # Одновременная подготовка одной директории несколькими потоками безопасна
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+        if uid and gid:
+            os.chown(path, uid, gid)
+        with self._lock:
+            self._ready.add(key)
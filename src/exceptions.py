@@ -22,5 +22,17 @@ class CopyFileError(Exception):
     """Ошибка копирования файла"""
 
 
+class ChecksumMismatchError(CopyFileError):
+    """Копия файла не совпадает с исходным файлом"""
+
+
+class LinkFileError(Exception):
+    """Ошибка создания жесткой ссылки"""
+
+
 class ConfigError(Exception):
     """Ошибка конфигурации"""
+
+
+class CircuitOpenError(Exception):
+    """Ресурс недоступен, операции приостановлены до окончания окна переноса"""
@@ -0,0 +1,73 @@
+import ctypes
+import logging
+import os
+import platform
+
+logger = logging.getLogger(__name__)
+
+# Номера системного вызова ioprio_set по архитектурам
+_SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def prefetch_file(path: str | os.PathLike):
+    """Запускает фоновое чтение файла в кеш (WILLNEED), чтобы к копированию данные уже были в памяти"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError as e:
+        logger.debug(f'Не удалось запросить предварительное чтение {path}. Ошибка: {e}')
+    finally:
+        os.close(fd)
+
+
+def evict_from_cache(fd: int):
+    """Вытесняет страницы файла из кеша (DONTNEED). Измененные страницы вытесняются только после
+    их записи на носитель, поэтому для копии вызывается повторно позже (evict_file_from_cache)"""
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        logger.debug(f'Не удалось вытеснить файл из кеша. Ошибка: {e}')
+
+
+def evict_file_from_cache(path: str | os.PathLike):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        evict_from_cache(fd)
+    finally:
+        os.close(fd)
+
+
+def set_idle_io_priority(nice: int = 0) -> bool:
+    """Переводит текущий поток в класс ввода-вывода idle и понижает приоритет планировщика на nice.
+    Создаваемые после этого потоки наследуют приоритеты, поэтому вызывается до запуска рабочих потоков"""
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            logger.error(f'Не удалось понизить приоритет процесса. Ошибка: {e}')
+    syscall_number = _SYS_IOPRIO_SET.get(platform.machine())
+    if syscall_number is None:
+        logger.error(f'Класс ввода-вывода idle не поддерживается на {platform.machine()}.')
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        logger.error(f'Не удалось установить класс ввода-вывода idle. Ошибка: {os.strerror(ctypes.get_errno())}')
+        return False
+    return True
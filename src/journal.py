@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from enum import StrEnum
+
+logger = logging.getLogger(__name__)
+
+
+class JournalState(StrEnum):
+    # Файл выбран для переноса, копирование могло начаться
+    planned = 'planned'
+    # Копия полностью записана (для ненайденных в БД - под временным именем с префиксом)
+    copied = 'copied'
+    # Копия ненайденного в БД файла переименована в итоговое имя
+    renamed = 'renamed'
+    # image в БД указывает на копию
+    db_updated = 'db_updated'
+    # Исходный файл удален, перенос завершен
+    source_removed = 'source_removed'
+
+
+@dataclass
+class JournalEntry:
+    id: int
+    path_from: str
+    path_to: str
+    path_tmp: str | None
+    image_id: int | None
+    share_uid: int | None
+    image_path: str | None
+    state: JournalState
+    # Копию создал этот перенос. Иначе path_to совпадал с исходным файлом до переноса и при откате не удаляется
+    is_copy_created: bool = True
+
+
+class Journal:
+    """Локальный журнал переходов состояний переноса файлов.
+    Хранит только незавершенные переносы: после удаления исходного файла запись удаляется.
+    По записям, оставшимся после аварийного завершения, следующий запуск доводит или откатывает перенос"""
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute('pragma synchronous=normal')
+        self._conn.execute(
+            """create table if not exists moves (
+                id integer primary key autoincrement,
+                path_from text not null,
+                path_to text not null,
+                path_tmp text,
+                image_id integer,
+                share_uid integer,
+                image_path text,
+                state text not null,
+                updated_at real not null,
+                is_copy_created integer not null default 1
+            )"""
+        )
+        # Журнал, созданный предыдущей версией, дополняется новым столбцом
+        columns = {row[1] for row in self._conn.execute('pragma table_info(moves)')}
+        if 'is_copy_created' not in columns:
+            self._conn.execute('alter table moves add column is_copy_created integer not null default 1')
+
+    def plan(
+        self,
+        path_from: str,
+        path_to: str,
+        path_tmp: str | None = None,
+        image_id: int | None = None,
+        share_uid: int | None = None,
+        image_path: str | None = None,
+        is_copy_created: bool = True,
+    ) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                """insert into moves (path_from, path_to, path_tmp, image_id, share_uid, image_path, state, updated_at,
+                is_copy_created)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (path_from, path_to, path_tmp, image_id, share_uid, image_path, JournalState.planned, time.time(),
+                 is_copy_created),
+            )
+            return cursor.lastrowid
+
+    def mark(self, entry_ids: int | list[int], state: JournalState):
+        if isinstance(entry_ids, int):
+            entry_ids = [entry_ids]
+        if state == JournalState.source_removed:
+            self.finish(entry_ids)
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute('begin')
+            self._conn.executemany(
+                'update moves set state = ?, updated_at = ? where id = ?',
+                [(state, now, entry_id) for entry_id in entry_ids],
+            )
+            self._conn.execute('commit')
+
+    def finish(self, entry_ids: int | list[int]):
+        """Удаляет записи завершенных или откаченных переносов"""
+        if isinstance(entry_ids, int):
+            entry_ids = [entry_ids]
+        with self._lock:
+            self._conn.execute('begin')
+            self._conn.executemany('delete from moves where id = ?', [(entry_id,) for entry_id in entry_ids])
+            self._conn.execute('commit')
+
+    def unfinished(self, path_from_dir: str | None = None) -> list[JournalEntry]:
+        """Незавершенные переносы, с path_from_dir - только файлов из этой директории и поддиректорий"""
+        with self._lock:
+            rows = self._conn.execute(
+                """select id, path_from, path_to, path_tmp, image_id, share_uid, image_path, state, is_copy_created
+                from moves order by id"""
+            ).fetchall()
+        if path_from_dir:
+            prefix = os.path.join(path_from_dir, '')
+            rows = [row for row in rows if row[1].startswith(prefix)]
+        return [JournalEntry(*row[:7], state=JournalState(row[7]), is_copy_created=bool(row[8])) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,7 +1,19 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
 
+from datetime import datetime
 from enum import StrEnum
 
+TEXT_FORMAT = '%(asctime)s - %(threadName)s - %(name)s - %(levelname)s - %(message)s'
+# Атрибуты, которые есть у любой записи лога. Остальные переданы через extra и пишутся в JSON отдельными полями
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+# Запущенные фоновые потоки записи лога
+_listeners: list[logging.handlers.QueueListener] = []
+
 
 class LogLevels(StrEnum):
     info = 'INFO'
@@ -10,14 +22,80 @@ class LogLevels(StrEnum):
     debug = 'DEBUG'
 
 
-def configure_logging(level: str, filename: str):
+class LogFormat(StrEnum):
+    text = 'text'
+    # Одна JSON запись на строку с полями файла (path, bytes, status, duration_s...) из extra
+    json = 'json'
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """В отличие от QueueHandler не вписывает трассировку исключения в сообщение: exc_info передается
+    фоновому потоку, и JsonFormatter пишет ее в поле exc"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _file_handler(filename: str, max_bytes: int, backup_count: int, rotate_when: str) -> logging.Handler:
+    if rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            filename, when=rotate_when, backupCount=backup_count, encoding='utf-8')
+    if max_bytes:
+        return logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    return logging.FileHandler(filename, encoding='utf-8')
+
+
+def configure_logging(
+    level: str,
+    filename: str,
+    log_format: LogFormat = LogFormat.text,
+    max_bytes: int = 0,
+    backup_count: int = 5,
+    rotate_when: str = '',
+) -> logging.handlers.QueueListener:
+    """Потоки переноса только кладут записи в очередь, в файл их пишет фоновый поток.
+    Файл ротируется по времени (rotate_when, например midnight) или по размеру (max_bytes)"""
     log_level = level.upper()
 
-    if log_level not in LogLevels:
+    if log_level not in list(LogLevels):
         log_level = LogLevels.info
 
-    logging.basicConfig(
-        filename=filename,
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    )
+    handler = _file_handler(filename, max_bytes, backup_count, rotate_when)
+    handler.setFormatter(JsonFormatter() if log_format == LogFormat.json else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.addHandler(_QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+@atexit.register
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает фоновую запись лога"""
+    while _listeners:
+        _listeners.pop().stop()
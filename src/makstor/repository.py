@@ -1,3 +1,5 @@
+from typing import Iterator
+
 import pydicom
 
 from src.database import DatabaseConnector
@@ -30,6 +32,39 @@ class MakstorRepository:
             ).fetchone()
             return result
 
+    def get_images_by_ids(self, ids: list[int]) -> dict[int, tuple]:
+        if not ids:
+            return {}
+        with self.db_connector as db:
+            result = db.execute(
+                """select image_uid, image_path from images where image_uid = any(%s)""",
+                (list(ids),),
+            ).fetchall()
+            return {row[0]: row for row in result}
+
+    def get_images_by_uids(self, uids_in_file: list[str]) -> dict[str, tuple]:
+        if not uids_in_file:
+            return {}
+        with self.db_connector as db:
+            result = db.execute(
+                """select image_uid, image_path, images_uid_in_file from images 
+                where images_uid_in_file = any(%s)""",
+                (list(uids_in_file),),
+            ).fetchall()
+            return {row[2]: row[:2] for row in result}
+
+    def iter_images_by_share(self, share_uid: int) -> Iterator[tuple[int, str]]:
+        """Построчно возвращает (image_uid, image_path) тома, упорядоченные по image_path
+        в порядке кодов символов (как сортировка строк в Python)"""
+        with self.db_connector as db:
+            yield from db.stream(
+                """select image_uid, image_path from images 
+                where share_uid = %s 
+                order by image_path collate "C\"""",
+                (share_uid,),
+                name=f'images_share_{share_uid}',
+            )
+
     def update_image(self, image_id: int, share_uid: int, image_path: str):
         with self.db_connector as db:
             db.execute(
@@ -37,3 +72,17 @@ class MakstorRepository:
                 set share_uid={share_uid}, image_path='{image_path}' 
                 where image_uid={image_id}"""
             )
+
+    def update_images(self, rows: list[tuple[int, int, str]]):
+        """Обновляет share_uid и image_path для строк (image_uid, share_uid, image_path) одной транзакцией"""
+        if not rows:
+            return
+        with self.db_connector.transaction() as db:
+            db.execute_values(
+                """update images 
+                set share_uid = v.share_uid, image_path = v.image_path 
+                from (values %s) as v(image_uid, share_uid, image_path) 
+                where images.image_uid = v.image_uid""",
+                rows,
+                page_size=len(rows),
+            )
@@ -0,0 +1,202 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from enum import StrEnum
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности этапов, сек.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class Stage(StrEnum):
+    extract_id = 'extract_id'
+    db_lookup = 'db_lookup'
+    dicom_parse = 'dicom_parse'
+    copy = 'copy'
+    db_update = 'db_update'
+    unlink = 'unlink'
+    dir_remove = 'dir_remove'
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent: float) -> float:
+        """Оценка перцентиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum_s': self.sum,
+            'max_s': self.max,
+            'p50_s': self.percentile(50),
+            'p90_s': self.percentile(90),
+            'p99_s': self.percentile(99),
+            'buckets': {('+Inf' if math.isinf(bound) else str(bound)): count
+                        for bound, count in zip(BUCKETS, self.buckets)},
+        }
+
+
+class StageMetrics:
+    """Гистограммы этапов, объем скопированных данных и статусы файлов для директории или запуска"""
+
+    def __init__(self):
+        self.stages: dict[Stage, Histogram] = {stage: Histogram() for stage in Stage}
+        self.copied_bytes = 0
+        self.statuses: Counter = Counter()
+
+    def to_dict(self) -> dict:
+        return {
+            'stages': {stage: histogram.to_dict() for stage, histogram in self.stages.items() if histogram.count},
+            'copied_bytes': self.copied_bytes,
+            'statuses': {status.name.lower(): count for status, count in self.statuses.items()},
+        }
+
+
+class RunMetrics:
+    """Метрики запуска переноса: итоги по запуску и по каждой директории"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.run = StageMetrics()
+        self.dirs: dict[str, StageMetrics] = {}
+        self._current_dir: StageMetrics | None = None
+        self._lock = threading.Lock()
+
+    def begin_dir(self, name: str):
+        """Дальнейшие измерения относятся к директории name (директории обрабатываются по очереди)"""
+        with self._lock:
+            self._current_dir = self.dirs.setdefault(name, StageMetrics())
+
+    def _targets(self) -> list[StageMetrics]:
+        return [self.run, self._current_dir] if self._current_dir else [self.run]
+
+    def observe(self, stage: Stage, duration: float, copied_bytes: int = 0):
+        with self._lock:
+            for target in self._targets():
+                target.stages[stage].observe(duration)
+                target.copied_bytes += copied_bytes
+
+    @contextmanager
+    def measure(self, stage: Stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def add_statuses(self, statuses: Counter):
+        with self._lock:
+            for target in self._targets():
+                target.statuses.update(statuses)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'duration_s': self.duration,
+                'run': self.run.to_dict(),
+                'dirs': {name: metrics.to_dict() for name, metrics in self.dirs.items()},
+            }
+
+    def to_prometheus(self, prefix: str = 'filesync', labels: dict[str, str] | None = None) -> str:
+        """Метрики запуска в текстовом формате Prometheus (для textfile collector node_exporter).
+        labels добавляются ко всем значениям, чтобы файлы нескольких политик не конфликтовали"""
+        common = ''.join(f'{key}="{value}",' for key, value in (labels or {}).items())
+        plain = f'{{{common.rstrip(",")}}}' if common else ''
+        lines = [
+            f'# HELP {prefix}_stage_duration_seconds Длительность этапов переноса файлов.',
+            f'# TYPE {prefix}_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            for stage, histogram in self.run.stages.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    le = '+Inf' if math.isinf(bound) else bound
+                    lines.append(f'{prefix}_stage_duration_seconds_bucket{{{common}stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_duration_seconds_sum{{{common}stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_duration_seconds_count{{{common}stage="{stage}"}} {histogram.count}')
+            lines += [
+                f'# HELP {prefix}_files Количество файлов по статусу переноса за последний запуск.',
+                f'# TYPE {prefix}_files gauge',
+            ]
+            for status, count in self.run.statuses.items():
+                lines.append(f'{prefix}_files{{{common}status="{status.name.lower()}"}} {count}')
+            lines += [
+                f'# HELP {prefix}_copied_bytes Объем скопированных данных за последний запуск.',
+                f'# TYPE {prefix}_copied_bytes gauge',
+                f'{prefix}_copied_bytes{plain} {self.run.copied_bytes}',
+                f'# HELP {prefix}_run_duration_seconds Длительность последнего запуска.',
+                f'# TYPE {prefix}_run_duration_seconds gauge',
+                f'{prefix}_run_duration_seconds{plain} {self.duration}',
+                f'# HELP {prefix}_last_run_timestamp_seconds Время завершения последнего запуска.',
+                f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+                f'{prefix}_last_run_timestamp_seconds{plain} {self.finished_at or time.time()}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, metrics_dir: str, name: str = 'filesync', labels: dict[str, str] | None = None):
+        """Сохраняет метрики в JSON (отдельный файл на запуск и last_run.json) и файл .prom"""
+        data = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        run_name = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        os.makedirs(metrics_dir, exist_ok=True)
+        _write_atomic(os.path.join(metrics_dir, f'{name}-{run_name}.json'), data)
+        _write_atomic(os.path.join(metrics_dir, f'{name}-last_run.json'), data)
+        _write_atomic(os.path.join(metrics_dir, f'{name}.prom'), self.to_prometheus(labels=labels))
+
+
+def _write_atomic(path: str, data: str):
+    """Записывает файл через временное имя, чтобы читатели не видели его частично записанным"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_last_run(metrics_dir: str, name: str = 'filesync') -> dict | None:
+    """Метрики последнего запуска, сохраненные write, или None, если их нет"""
+    try:
+        with open(os.path.join(metrics_dir, f'{name}-last_run.json'), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError) as err:
+        logger.debug(f'Не удалось прочитать метрики последнего запуска из {metrics_dir}. Ошибка: {err}')
+        return None
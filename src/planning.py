@@ -0,0 +1,87 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+
+@dataclass
+class DirPlan:
+    name: str
+    files: int = 0
+    bytes: int = 0
+    # Найдены в БД по id из имени файла
+    resolved: int = 0
+    # Найдены в БД по uid из DICOM файла (только с разбором DICOM)
+    resolved_by_uid: int = 0
+    # Не найдены в БД: без разбора DICOM - по id из имени, с разбором - совсем (уйдут в dir_not_found)
+    unresolved: int = 0
+    unresolved_bytes: int = 0
+    # Директория не будет перенесена из-за порогов заполненности томов
+    is_skipped: bool = False
+
+
+@dataclass
+class PlanReport:
+    policy: str
+    is_dicom_parsed: bool
+    dirs: list[DirPlan] = field(default_factory=list)
+    # Оценка длительности переноса по метрикам прошлого запуска, сек.
+    estimated_duration: float | None = None
+    deadline: datetime | None = None
+
+    @property
+    def planned_dirs(self) -> list[DirPlan]:
+        return [plan for plan in self.dirs if not plan.is_skipped]
+
+    @property
+    def files(self) -> int:
+        return sum(plan.files for plan in self.planned_dirs)
+
+    @property
+    def bytes(self) -> int:
+        return sum(plan.bytes for plan in self.planned_dirs)
+
+    @property
+    def unresolved(self) -> int:
+        return sum(plan.unresolved for plan in self.planned_dirs)
+
+    def estimate(self, last_run: dict | None):
+        """Оценивает длительность по скорости прошлого запуска в файлах/с и байтах/с (берется большая)"""
+        if not last_run or not last_run.get('duration_s'):
+            return
+        duration = last_run['duration_s']
+        run = last_run.get('run', {})
+        num_files = sum(run.get('statuses', {}).values())
+        copied_bytes = run.get('copied_bytes', 0)
+        estimates = []
+        if num_files:
+            estimates.append(self.files / (num_files / duration))
+        if copied_bytes:
+            estimates.append(self.bytes / (copied_bytes / duration))
+        self.estimated_duration = max(estimates, default=None)
+
+    @property
+    def fits_deadline(self) -> bool | None:
+        if self.estimated_duration is None or self.deadline is None:
+            return None
+        return datetime.now() + timedelta(seconds=self.estimated_duration) <= self.deadline
+
+    def format(self) -> str:
+        unresolved_title = 'не найдено в БД' if self.is_dicom_parsed else 'не найдено по id'
+        lines = [f'Политика {self.policy}:']
+        for plan in self.dirs:
+            line = (f'  {plan.name}: файлов {plan.files}, байт {plan.bytes}, найдено по id {plan.resolved}, '
+                    f'{unresolved_title} {plan.unresolved} ({plan.unresolved_bytes} байт)')
+            if self.is_dicom_parsed:
+                line += f', найдено по uid {plan.resolved_by_uid}'
+            if plan.is_skipped:
+                line += ' - не переносится из-за порогов заполненности'
+            lines.append(line)
+        lines.append(f'  Итого: директорий {len(self.planned_dirs)}, файлов {self.files}, байт {self.bytes}, '
+                     f'{unresolved_title} {self.unresolved}.')
+        if self.estimated_duration is None:
+            lines.append('  Оценка длительности недоступна: нет метрик прошлого запуска.')
+        else:
+            lines.append(f'  Оценка длительности: {timedelta(seconds=round(self.estimated_duration))}.')
+        if self.fits_deadline is not None:
+            lines.append(f'  До окончания окна {self.deadline:%Y-%m-%d %H:%M} '
+                         f'{"успевает" if self.fits_deadline else "не успевает"}.')
+        return '\n'.join(lines)
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+from datetime import datetime
+
+from src.app import FileSyncApp
+
+logger = logging.getLogger(__name__)
+
+
+class PolicyRunner:
+    """Выполняет переносы нескольких политик в одном процессе с общим пулом соединений с БД.
+    Политики работают параллельно, но с одним устройством (томом источника или целевым томом)
+    одновременно работает не больше max_runs_per_device политик"""
+
+    def __init__(self, apps: list[FileSyncApp], max_runs_per_device: int = 1):
+        self.apps = apps
+        self.max_runs_per_device = max(max_runs_per_device, 1)
+        self._device_slots: dict[tuple, threading.BoundedSemaphore] = {}
+
+    def _device_keys(self, app: FileSyncApp) -> list[tuple]:
+        """Ключи устройств политики. Недоступный том учитывается по uid, чтобы его не делили
+        политики с одним и тем же томом"""
+        devices = app.get_volume_devices()
+        keys = {
+            ('device', device) if device is not None else ('volume', volume_id)
+            for device, volume_id in zip(devices, (app.volume_from, app.volume_to))
+        }
+        # Единый порядок захвата исключает взаимную блокировку политик
+        return sorted(keys)
+
+    def _run_app(self, app: FileSyncApp, keys: list[tuple], deadline: datetime | None):
+        for key in keys:
+            self._device_slots[key].acquire()
+        try:
+            logger.info(f'Запущен перенос по политике {app.name}.')
+            app.run(deadline=deadline, replay_journal=False)
+        except Exception as err:
+            logger.exception(f'Ошибка при переносе по политике {app.name}. Ошибка: {err}')
+        finally:
+            for key in reversed(keys):
+                self._device_slots[key].release()
+
+    def run(self, deadline: datetime | None = None):
+        if len(self.apps) == 1:
+            self.apps[0].run(deadline=deadline)
+            return
+
+        # Журнал общий для политик - прерванные переносы разбираются до запуска потоков политик
+        for app in self.apps:
+            try:
+                app.replay_journal()
+            except Exception as err:
+                logger.exception(f'Ошибка при разборе журнала политики {app.name}. Ошибка: {err}')
+
+        app_keys = [(app, self._device_keys(app)) for app in self.apps]
+        for _, keys in app_keys:
+            for key in keys:
+                self._device_slots.setdefault(key, threading.BoundedSemaphore(self.max_runs_per_device))
+
+        threads = [
+            threading.Thread(target=self._run_app, args=(app, keys, deadline), name=app.name)
+            for app, keys in app_keys
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,113 @@
+import logging
+import os
+
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Iterator, TextIO
+
+from src.makstor.repository import MakstorRepository
+from src.utils import walk_files_sorted
+
+logger = logging.getLogger(__name__)
+
+# Количество image_uid в одном запросе файла исправлений
+FIX_BATCH_SIZE = 1000
+
+
+@dataclass
+class ReconcileResult:
+    share_uid: int
+    rows: int = 0
+    files: int = 0
+    matched: int = 0
+    # Файлы, на которые не указывает ни одна строка images
+    orphans: int = 0
+    # Строки images, файлов которых нет на томе
+    missing: int = 0
+    # Строки, пришедшие из БД не по порядку (после нормализации пути) - результат для них неточен
+    unordered: int = 0
+
+
+class Reconciler:
+    """Сверяет строки images тома с файлами на нем за один линейный проход: строки читаются серверным
+    курсором, файлы - ленивым обходом, оба потока упорядочены по относительному пути и сливаются.
+    Потерянные файлы и отсутствующие файлы строк пишутся в отчеты по мере нахождения"""
+
+    def __init__(self, repository: MakstorRepository, report_dir: str):
+        self.repository = repository
+        self.report_dir = report_dir
+
+    def _iter_rows(self, share_uid: int, result: ReconcileResult) -> Iterator[tuple[int, str]]:
+        previous_path = ''
+        for image_uid, image_path in self.repository.iter_images_by_share(share_uid):
+            image_path = (image_path or '').strip().lstrip('/')
+            if image_path < previous_path:
+                result.unordered += 1
+            previous_path = image_path
+            result.rows += 1
+            yield image_uid, image_path
+
+    def _iter_files(self, share_path: str, result: ReconcileResult) -> Iterator[str]:
+        for rel_path in walk_files_sorted(share_path):
+            result.files += 1
+            yield rel_path
+
+    def run(self, share_uid: int, write_fixes: bool = False) -> ReconcileResult | None:
+        """Сверяет том share_uid. С write_fixes дополнительно пишет пакеты SQL для удаления строк
+        без файлов - для проверки и ручного выполнения, сами строки не удаляются"""
+        share_path = self.repository.get_volume_path(share_uid)
+        if not share_path:
+            logger.error(f'Не удалось найти том с uid={share_uid}.')
+            return None
+        share_path = share_path.strip()
+        result = ReconcileResult(share_uid=share_uid)
+        os.makedirs(self.report_dir, exist_ok=True)
+        report_path = os.path.join(self.report_dir, f'share-{share_uid}')
+
+        logger.info(f'Сверка тома {share_uid} ({share_path}) с БД.')
+        with (
+            open(f'{report_path}-orphans.tsv', 'w', encoding='utf-8') as orphans_report,
+            open(f'{report_path}-missing.tsv', 'w', encoding='utf-8') as missing_report,
+            open(f'{report_path}-fixes.sql', 'w', encoding='utf-8') if write_fixes else nullcontext() as fixes,
+        ):
+            fix_batch: list[int] = []
+            rows = self._iter_rows(share_uid, result)
+            files = self._iter_files(share_path, result)
+            row = next(rows, None)
+            file_path = next(files, None)
+            while row is not None or file_path is not None:
+                if file_path is None or (row is not None and row[1] < file_path):
+                    result.missing += 1
+                    missing_report.write(f'{row[0]}\t{row[1]}\n')
+                    fix_batch.append(row[0])
+                    if len(fix_batch) >= FIX_BATCH_SIZE:
+                        self._write_fix_batch(fixes, share_uid, fix_batch)
+                    row = next(rows, None)
+                elif row is None or file_path < row[1]:
+                    result.orphans += 1
+                    orphans_report.write(f'{file_path}\n')
+                    file_path = next(files, None)
+                else:
+                    result.matched += 1
+                    # На один файл может указывать несколько строк
+                    while (row := next(rows, None)) is not None and row[1] == file_path:
+                        result.matched += 1
+                    file_path = next(files, None)
+            self._write_fix_batch(fixes, share_uid, fix_batch)
+
+        if result.unordered:
+            logger.warning(f'{result.unordered} строк тома {share_uid} пришли из БД не по порядку путей, '
+                           f'для них отчет может быть неточен.')
+        logger.info(f'Сверка тома {share_uid} завершена. Строк: {result.rows}, файлов: {result.files}, '
+                    f'совпало: {result.matched}, файлов без строк: {result.orphans}, '
+                    f'строк без файлов: {result.missing}. Отчеты: {report_path}-*.')
+        return result
+
+    @staticmethod
+    def _write_fix_batch(fixes: TextIO | None, share_uid: int, batch: list[int]):
+        if not batch or not fixes:
+            batch.clear()
+            return
+        fixes.write(f'delete from images where share_uid = {share_uid} '
+                    f'and image_uid in ({", ".join(map(str, batch))});\n')
+        batch.clear()
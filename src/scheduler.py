@@ -0,0 +1,169 @@
+import re
+import threading
+
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta
+
+# Максимальная длительность ожидания между проверками расписания, сек.
+# Ограничивает накопление погрешности sleep и влияние перевода системных часов
+MAX_SLEEP = 60
+# Глубина поиска ближайшего запуска по cron выражению, дней
+SEARCH_DAYS = 366 * 4
+
+_FIELD_RANGES = (
+    (0, 59),  # минуты
+    (0, 23),  # часы
+    (1, 31),  # день месяца
+    (1, 12),  # месяц
+    (0, 7),  # день недели, 0 и 7 - воскресенье
+)
+
+
+def _parse_field(field: str, lower: int, upper: int) -> set[int]:
+    """Разбирает поле cron выражения: *, числа, диапазоны a-b, списки через запятую и шаг /n"""
+    values = set()
+    for part in field.split(','):
+        match = re.fullmatch(r'(\*|\d+(?:-\d+)?)(?:/(\d+))?', part)
+        if not match:
+            raise ValueError(f'некорректное поле {field}')
+        range_str, step_str = match.groups()
+        if range_str == '*':
+            start, end = lower, upper
+        elif '-' in range_str:
+            start, end = map(int, range_str.split('-'))
+        else:
+            start = end = int(range_str)
+            if step_str:
+                end = upper
+        step = int(step_str) if step_str else 1
+        if start < lower or end > upper or start > end or step < 1:
+            raise ValueError(f'значение поля {field} вне диапазона {lower}-{upper}')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    """Cron выражение из пяти полей: минуты, часы, день месяца, месяц, день недели"""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'{expression} - ожидается 5 полей')
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, *field_range) for field, field_range in zip(fields, _FIELD_RANGES)
+        )
+        # В cron воскресенье 0 или 7, в datetime.weekday() понедельник 0
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        # Если ограничены и день месяца, и день недели, подходит любой из них (как в cron)
+        self.is_days_restricted = fields[2] != '*'
+        self.is_weekdays_restricted = fields[4] != '*'
+
+    def _matches_date(self, dt: datetime) -> bool:
+        if dt.month not in self.months:
+            return False
+        day_match = dt.day in self.days
+        weekday_match = dt.weekday() in self.weekdays
+        if self.is_days_restricted and self.is_weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_after(self, after: datetime) -> datetime | None:
+        """Ближайший момент срабатывания строго после after"""
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(SEARCH_DAYS):
+            if self._matches_date(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        return None
+
+
+@dataclass
+class RunWindow:
+    """Окно запуска: начало по cron выражению и необязательное время, после которого
+    новые файлы в перенос не берутся"""
+    start: CronExpression
+    deadline: time | None = None
+
+    @classmethod
+    def parse(cls, value: str) -> 'RunWindow':
+        """Разбирает окно вида '0 1 * * *' или '0 1 * * * until 06:00'"""
+        expression, _, deadline_str = value.partition(' until ')
+        deadline = None
+        if deadline_str:
+            try:
+                deadline = datetime.strptime(deadline_str.strip(), '%H:%M').time()
+            except ValueError:
+                raise ValueError(f'{deadline_str} - время указано некорректно. Формат: %H:%M')
+        return cls(start=CronExpression(expression.strip()), deadline=deadline)
+
+    def deadline_after(self, start: datetime) -> datetime | None:
+        """Ближайшее наступление времени окончания окна после его начала"""
+        if self.deadline is None:
+            return None
+        deadline = datetime.combine(start.date(), self.deadline)
+        if deadline <= start:
+            deadline += timedelta(days=1)
+        return deadline
+
+
+@dataclass
+class ScheduledRun:
+    start: datetime
+    deadline: datetime | None = None
+
+
+class Scheduler:
+    """Ожидает ближайшее окно запуска. Запуск вне расписания запрашивается методом trigger
+    (например, из обработчика сигнала)"""
+
+    def __init__(self, windows: list[RunWindow]):
+        self.windows = windows
+        self._triggered = threading.Event()
+
+    def trigger(self):
+        self._triggered.set()
+
+    def next_run(self, after: datetime) -> ScheduledRun | None:
+        runs = []
+        for window in self.windows:
+            start = window.start.next_after(after)
+            if start:
+                runs.append(ScheduledRun(start=start, deadline=window.deadline_after(start)))
+        return min(runs, key=lambda run: run.start, default=None)
+
+    def wait(self) -> ScheduledRun:
+        """Ждет начала ближайшего окна или запроса на внеочередной запуск и возвращает запуск.
+        Внеочередной запуск ограничен временем окончания текущего окна расписания, если оно идет"""
+        scheduled = self.next_run(datetime.now())
+        while True:
+            now = datetime.now()
+            if self._triggered.is_set():
+                self._triggered.clear()
+                return ScheduledRun(start=now, deadline=self._current_deadline(now))
+            if scheduled and now >= scheduled.start:
+                return scheduled
+            timeout = MAX_SLEEP
+            if scheduled:
+                timeout = min(timeout, max((scheduled.start - now).total_seconds(), 0))
+            self._triggered.wait(timeout)
+
+    def _current_deadline(self, now: datetime) -> datetime | None:
+        """Время окончания окна, которое началось раньше now и еще не закончилось"""
+        deadlines = []
+        for window in self.windows:
+            if window.deadline is None:
+                continue
+            # Начало окна ищется за сутки до now - окна длиннее суток не поддерживаются
+            start = window.start.next_after(now - timedelta(days=1))
+            while start and start <= now:
+                deadline = window.deadline_after(start)
+                if deadline > now:
+                    deadlines.append(deadline)
+                start = window.start.next_after(start)
+        return min(deadlines, default=None)
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Коэффициент сглаживания средней задержки копирования
+LATENCY_EWMA_ALPHA = 0.2
+# Во сколько раз снижается доля времени копирования при превышении целевой задержки
+BACKOFF_FACTOR = 0.7
+# На сколько доля времени копирования восстанавливается, пока задержка ниже целевой
+RECOVERY_STEP = 0.05
+# Минимальная доля времени копирования в адаптивном режиме
+MIN_DUTY = 0.05
+# Объем, к которому приводится задержка копирования: файлы меньше учитываются целиком,
+# больше - пропорционально размеру, чтобы большой файл на исправном томе не считался медленным
+LATENCY_UNIT = 1024 * 1024
+
+
+class TokenBucket:
+    """Ограничивает скорость rate единиц в секунду с накоплением до burst единиц.
+    Запрос больше burst не отклоняется: токены уходят в долг, а вызывающий поток ждет его погашения"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1, rate_factor: float = 1.0):
+        """Забирает amount токенов, при нехватке ждет. rate_factor временно снижает скорость пополнения"""
+        rate = self.rate * rate_factor
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * rate)
+            self._updated_at = now
+            self._tokens -= amount
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class CopyThrottle:
+    """Ограничивает копирование на один целевой том по объему и количеству файлов в секунду.
+    В адаптивном режиме при росте средней задержки копирования LATENCY_UNIT байт выше целевой
+    между копированиями вставляются паузы, а заданные ограничения скорости пропорционально снижаются"""
+
+    def __init__(
+        self,
+        name: str,
+        bytes_per_s: float = 0,
+        files_per_s: float = 0,
+        adaptive: bool = False,
+        target_latency: float = 0.5,
+    ):
+        self.name = name
+        self.bytes_bucket = TokenBucket(bytes_per_s) if bytes_per_s > 0 else None
+        self.files_bucket = TokenBucket(files_per_s) if files_per_s > 0 else None
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        # Доля времени, которую поток может тратить на копирование
+        self.duty = 1.0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self.bytes_bucket or self.files_bucket or self.adaptive)
+
+    def acquire(self, size: int):
+        """Ждет разрешения на копирование файла размером size байт"""
+        duty = self.duty
+        if self.files_bucket:
+            self.files_bucket.acquire(1, rate_factor=duty)
+        if self.bytes_bucket and size:
+            self.bytes_bucket.acquire(size, rate_factor=duty)
+
+    def observe(self, latency: float, size: int = 0):
+        """Учитывает задержку копирования файла размером size байт и в адаптивном режиме выдерживает паузу"""
+        if not self.adaptive:
+            return
+        unit_latency = latency * LATENCY_UNIT / max(size, LATENCY_UNIT)
+        with self._lock:
+            self.latency = unit_latency if not self.latency else (
+                LATENCY_EWMA_ALPHA * unit_latency + (1 - LATENCY_EWMA_ALPHA) * self.latency
+            )
+            previous_duty = self.duty
+            if self.latency > self.target_latency:
+                self.duty = max(MIN_DUTY, self.duty * BACKOFF_FACTOR)
+            elif self.latency < self.target_latency / 2:
+                self.duty = min(1.0, self.duty + RECOVERY_STEP)
+            duty = self.duty
+        if duty < previous_duty:
+            logger.debug('Ограничение копирования на %s: задержка %.3f с на МБ, доля времени копирования %.2f.',
+                         self.name, self.latency, duty)
+        if duty < 1.0:
+            # Пауза такой длины, чтобы копирование занимало долю duty времени потока
+            time.sleep(latency * (1 / duty - 1))
+
+
+def make_throttle(name: str, is_network: bool, *args) -> CopyThrottle | None:
+    """Ограничение копирования на том (аргументы CopyThrottle после name). None - если том не сетевой
+    или ограничения не заданы"""
+    if not is_network:
+        return None
+    throttle = CopyThrottle(name, *args)
+    return throttle if throttle.is_enabled else None
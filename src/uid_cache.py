@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedUid:
+    # None - uid не удалось извлечь из файла
+    image_uid: str | None
+    # Результат последнего запроса image по uid в БД (None - не найден)
+    image: tuple | None
+    # Время последнего запроса в БД, None - запрос не выполнялся
+    lookup_at: float | None
+
+
+class UidCache:
+    """Кеш uid из DICOM файлов и результатов их поиска в БД.
+    Ключ - устройство и inode файла, запись действительна пока не изменились размер и время модификации.
+    Размер ограничен max_entries, вытесняются давно не использованные записи"""
+
+    # Проверка переполнения выполняется раз в столько добавлений
+    evict_interval = 1000
+
+    def __init__(self, path: str, max_entries: int = 100000, lookup_ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.lookup_ttl = lookup_ttl
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('pragma journal_mode=wal')
+        self._conn.execute('pragma synchronous=normal')
+        self._conn.execute(
+            """create table if not exists uids (
+                dev integer not null,
+                ino integer not null,
+                size integer not null,
+                mtime_ns integer not null,
+                image_uid text,
+                image text,
+                lookup_at real,
+                last_access real not null,
+                primary key (dev, ino)
+            )"""
+        )
+        self._conn.execute('create index if not exists uids_last_access on uids (last_access)')
+
+    def get(self, stat: os.stat_result) -> CachedUid | None:
+        with self._lock:
+            row = self._conn.execute(
+                'select size, mtime_ns, image_uid, image, lookup_at from uids where dev = ? and ino = ?',
+                (stat.st_dev, stat.st_ino),
+            ).fetchone()
+            if not row:
+                return None
+            size, mtime_ns, image_uid, image, lookup_at = row
+            if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+                # Файл изменился или inode занят другим файлом
+                self._conn.execute('delete from uids where dev = ? and ino = ?', (stat.st_dev, stat.st_ino))
+                return None
+            self._conn.execute(
+                'update uids set last_access = ? where dev = ? and ino = ?',
+                (time.time(), stat.st_dev, stat.st_ino),
+            )
+        image = tuple(json.loads(image)) if image else None
+        # Устаревший результат запроса в БД не используется, но uid из файла остается действительным
+        if lookup_at is not None and time.time() - lookup_at > self.lookup_ttl:
+            image, lookup_at = None, None
+        return CachedUid(image_uid=image_uid, image=image, lookup_at=lookup_at)
+
+    def put(self, stat: os.stat_result, image_uid: str | None, image: tuple | None = None, is_looked_up: bool = False):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """insert or replace into uids (dev, ino, size, mtime_ns, image_uid, image, lookup_at, last_access)
+                values (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    stat.st_dev,
+                    stat.st_ino,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    image_uid,
+                    json.dumps(image) if image else None,
+                    now if is_looked_up else None,
+                    now,
+                ),
+            )
+            self._puts += 1
+            if self._puts % self.evict_interval == 0:
+                self._evict()
+
+    def _evict(self):
+        count = self._conn.execute('select count(*) from uids').fetchone()[0]
+        if count <= self.max_entries:
+            return
+        logger.debug(f'Вытеснение {count - self.max_entries} записей из кеша uid.')
+        self._conn.execute(
+            'delete from uids where rowid in (select rowid from uids order by last_access limit ?)',
+            (count - self.max_entries,),
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,14 +1,15 @@
 import logging
 import os
 import re
-import shutil
 import pwd
 import grp
 
 from datetime import datetime, timedelta
-from typing import Callable
+from typing import Callable, Iterator
 
-from src.exceptions import RemoveFileError, CopyFileError, RenameFileError, RemoveDirError
+from src.copier import CopyEngine, CopyResult, default_copy_engine
+from src.directories import DirectoryManager
+from src.exceptions import RemoveFileError, CopyFileError, RenameFileError, RemoveDirError, LinkFileError
 
 logger = logging.getLogger(__name__)
 
@@ -75,6 +76,59 @@ def scan_directory(
     return result
 
 
+def walk_files(path: str) -> Iterator[os.DirEntry]:
+    """Лениво обходит директорию и все поддиректории, возвращая файлы по мере чтения.
+    В памяти хранятся только пути еще не обойденных поддиректорий"""
+    pending_dirs = [path]
+    while pending_dirs:
+        current = pending_dirs.pop()
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except OSError as e:
+            logger.error(f'Не удалось прочитать директорию {current}. Ошибка: {e}')
+        # Поддиректории обходятся в порядке имен
+        pending_dirs.extend(sorted(subdirs, reverse=True))
+
+
+def _sorted_children(path: str, rel_path: str) -> list[tuple[str, bool]]:
+    """Относительные пути файлов и поддиректорий в порядке, в котором идут полные пути при сортировке"""
+    children = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir or entry.is_file(follow_symlinks=False):
+                    children.append((f'{rel_path}{entry.name}', is_dir))
+    except OSError as e:
+        logger.error(f'Не удалось прочитать директорию {path}. Ошибка: {e}')
+    # Содержимое директории 'a' идет после файла 'a-b', так как '/' больше '-'
+    children.sort(key=lambda child: f'{child[0]}/' if child[1] else child[0])
+    return children
+
+
+def walk_files_sorted(path: str) -> Iterator[str]:
+    """Лениво обходит директорию и поддиректории, возвращая относительные пути файлов
+    в порядке сортировки путей по кодам символов. В памяти хранится содержимое только
+    директорий на текущем пути обхода"""
+    stack = [iter(_sorted_children(path, ''))]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        rel_path, is_dir = child
+        if is_dir:
+            stack.append(iter(_sorted_children(os.path.join(path, rel_path), f'{rel_path}/')))
+        else:
+            yield rel_path
+
+
 def is_empty_dir(path: str) -> bool:
     """Проверяет пустоту директории"""
     if next(os.scandir(path), None):
@@ -98,21 +152,63 @@ def remove_file(path: str | bytes | os.PathLike[str] | os.PathLike[bytes]):
         raise RemoveFileError(e)
 
 
-def copy_file(path_from: str, path_to: str, uid: int | None = None, gid: int | None = None):
-    """Копирует файл в папку (создает если нет) и устанавливает владельца и группу"""
-    path_to_dir = os.path.dirname(path_to)
+def copy_file(
+    path_from: str,
+    path_to: str,
+    uid: int | None = None,
+    gid: int | None = None,
+    copy_engine: CopyEngine = default_copy_engine,
+    dir_manager: DirectoryManager | None = None,
+) -> CopyResult:
+    """Копирует файл в папку (создает если нет) и устанавливает владельца и группу.
+    Возвращает способ, которым были скопированы данные, и хеш, если включена проверка"""
     try:
-        if not os.path.exists(path_to_dir) or not os.path.isdir(path_to_dir):
-            os.makedirs(path_to_dir, exist_ok=True)
-        shutil.copy2(path_from, path_to)
         # Если указан uid и gid ставлю владельца и группу для папки и файла
+        prepare_dir(os.path.dirname(path_to), uid, gid, dir_manager)
+        result = copy_engine.copy(path_from, path_to)
         if uid and gid:
-            os.chown(path_to_dir, uid, gid)
             os.chown(path_to, uid, gid)
+        return result
     except Exception as e:
         raise CopyFileError(e)
 
 
+def prepare_dir(path: str, uid: int | None = None, gid: int | None = None, dir_manager: DirectoryManager | None = None):
+    """Создает директорию (если нет) и устанавливает владельца и группу"""
+    if dir_manager:
+        dir_manager.ensure(path, uid, gid)
+        return
+    if not os.path.exists(path) or not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    if uid and gid:
+        os.chown(path, uid, gid)
+
+
+def link_file(
+    path_from: str,
+    path_to: str,
+    uid: int | None = None,
+    gid: int | None = None,
+    dir_manager: DirectoryManager | None = None,
+):
+    """Создает жесткую ссылку на файл в папке (создает если нет, с владельцем и группой uid, gid).
+    Владелец файла не меняется: ссылка и исходный файл - один inode, а исходный файл до обновления в БД
+    и при откате переноса должен оставаться прежним"""
+    try:
+        prepare_dir(os.path.dirname(path_to), uid, gid, dir_manager)
+        os.link(path_from, path_to)
+    except OSError as e:
+        raise LinkFileError(e)
+
+
+def is_same_filesystem(path_a: str, path_b: str) -> bool:
+    """Проверяет, что пути находятся на одной файловой системе"""
+    try:
+        return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+    except OSError:
+        return False
+
+
 def rename_file(path_from: str, path_to: str):
     """Переименовывает файл/директорию"""
     try: